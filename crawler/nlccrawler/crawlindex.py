@@ -0,0 +1,123 @@
+"""An index of books crawled before, for incremental crawls to skip unchanged ones"""
+
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+
+def brief_hash(name, brief):
+    """Hash of a book as listed on list pages, which changes along with its details"""
+    return hashlib.sha1(f"{name}\n{brief}".encode("utf-8")).hexdigest()
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+class CrawlIndex:
+    """Books crawled before, by `(of_collection_name, id)`, with their brief hash and the time
+    they were crawled
+
+    A book is fresh if its brief hash is unchanged and it was crawled within `ttl`. Without a
+    `ttl`, books never expire, while books of unknown crawl time are taken as expired with it.
+    Books crawled are recorded with `add`, and are appended to `path` if given.
+    """
+
+    def __init__(self, entries=None, ttl=None, path=None):
+        self.entries = entries or {}
+        self.ttl = ttl
+        self.file = open(path, "a", encoding="utf-8") if path else None
+
+    @classmethod
+    def from_file(cls, path, ttl=None):
+        """Load from, and record to, a JSONL file, where later lines take precedence"""
+        entries = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    entries[entry["of_collection_name"], entry["id"]] = (
+                        entry["brief_hash"],
+                        entry["crawled_at"],
+                    )
+        logger.info(f"Loaded {len(entries)} books crawled before from {path}")
+        return cls(entries, ttl, path)
+
+    @classmethod
+    def from_mongo(cls, mongo_uri, db_name, ttl=None):
+        """Load from the books and list pages stored by `TxMongoPipeline`
+
+        Books crawled are recorded there by the pipeline, as their `crawled_at` is stored along.
+        Books with some of their volumes missing are left out, to be crawled again.
+        """
+        from pymongo import MongoClient
+
+        client = MongoClient(mongo_uri)
+        try:
+            db = client[db_name]
+            briefs = {}
+            for page in db.pages.find({}, {"books": 1}):
+                for book in page["books"]:
+                    briefs[book["of_collection_name"], book["id"]] = brief_hash(
+                        book["name"], book["brief"]
+                    )
+            volumes_per_book = {
+                "$group": {
+                    "_id": ["$of_collection_name", "$of_book_id"],
+                    "count": {"$sum": 1},
+                }
+            }
+            volume_counts = {
+                tuple(group["_id"]): group["count"]
+                for group in db.volumes.aggregate([volumes_per_book])
+            }
+            entries = {}
+            for book in db.books.find(
+                {}, {"id": 1, "of_collection_name": 1, "crawled_at": 1, "volumes": 1}
+            ):
+                key = book["of_collection_name"], book["id"]
+                if key in briefs and volume_counts.get(key, 0) >= len(book["volumes"]):
+                    entries[key] = (briefs[key], book.get("crawled_at"))
+        finally:
+            client.close()
+        logger.info(f"Loaded {len(entries)} books crawled before from {db_name}")
+        return cls(entries, ttl)
+
+    def is_fresh(self, collection_name, book_id, hash):
+        try:
+            known_hash, crawled_at = self.entries[collection_name, book_id]
+        except KeyError:
+            return False
+        if known_hash != hash:
+            return False
+        if self.ttl is None:
+            return True
+        return crawled_at is not None and datetime.fromisoformat(
+            crawled_at
+        ) + self.ttl > datetime.now(timezone.utc)
+
+    def add(self, collection_name, book_id, hash, crawled_at):
+        self.entries[collection_name, book_id] = (hash, crawled_at)
+        if self.file is not None:
+            entry = {
+                "of_collection_name": collection_name,
+                "id": book_id,
+                "brief_hash": hash,
+                "crawled_at": crawled_at,
+            }
+            self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def ttl_of_days(days):
+    return timedelta(days=float(days)) if days else None
@@ -0,0 +1,122 @@
+# HTTP cache storage and policy for re-running spiders on responses crawled before, e.g.
+# after fixing parsers
+#
+# See: https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
+
+import hashlib
+import logging
+import sqlite3
+from pathlib import Path
+from time import time
+
+import zstandard
+from scrapy.extensions.httpcache import DummyPolicy
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+from w3lib.url import canonicalize_url
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    fingerprint TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    headers BLOB NOT NULL,
+    body BLOB NOT NULL,  -- compressed with zstd
+    stored_at REAL NOT NULL
+)
+"""
+
+
+def request_fingerprint(request):
+    """Identify a request by its method, canonical URL and body
+
+    The body tells apart POST requests to the same URL, such as those to `formatCatalog`.
+    """
+    fingerprint = hashlib.sha1()
+    fingerprint.update(request.method.encode("ascii") + b"\n")
+    fingerprint.update(canonicalize_url(request.url).encode("utf-8") + b"\n")
+    fingerprint.update(request.body or b"")
+    return fingerprint.hexdigest()
+
+
+class SqliteZstdCacheStorage:
+    """Store responses in a single SQLite database per spider, with bodies compressed by zstd
+
+    Set `HTTPCACHE_STORAGE = "nlccrawler.httpcache.SqliteZstdCacheStorage"` to use it. The
+    database is kept at `HTTPCACHE_DIR/<spider name>.sqlite3`, and bodies are compressed at
+    `HTTPCACHE_ZSTD_LEVEL` (3 by default).
+    """
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings["HTTPCACHE_DIR"], createdir=True)
+        self.expiration_secs = settings.getint("HTTPCACHE_EXPIRATION_SECS")
+        level = settings.getint("HTTPCACHE_ZSTD_LEVEL", 3)
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.decompressor = zstandard.ZstdDecompressor()
+        self.db = None
+
+    def open_spider(self, spider):
+        dbpath = Path(self.cachedir, f"{spider.name}.sqlite3")
+        self.db = sqlite3.connect(dbpath)
+        # each response is committed on its own, which is cheap without a sync per commit
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(SCHEMA)
+        self.db.commit()
+        logger.debug(
+            "Using SQLite cache storage in %(cachepath)s",
+            {"cachepath": dbpath},
+            extra={"spider": spider},
+        )
+
+    def close_spider(self, spider):
+        self.db.close()
+
+    def retrieve_response(self, spider, request):
+        row = self.db.execute(
+            "SELECT url, status, headers, body, stored_at FROM responses"
+            " WHERE fingerprint = ?",
+            (request_fingerprint(request),),
+        ).fetchone()
+        if row is None:
+            return None  # not cached
+        url, status, raw_headers, body, stored_at = row
+        if 0 < self.expiration_secs < time() - stored_at:
+            return None  # expired
+        request.meta["cache_timestamp"] = stored_at
+        headers = Headers(headers_raw_to_dict(raw_headers))
+        body = self.decompressor.decompress(body)
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=status, body=body)
+
+    def store_response(self, spider, request, response):
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                request_fingerprint(request),
+                response.url,
+                response.status,
+                headers_dict_to_raw(response.headers),
+                self.compressor.compress(response.body),
+                time(),
+            ),
+        )
+        self.db.commit()
+
+
+class ReplayPolicy(DummyPolicy):
+    """Serve any response cached, however old, and cache only successful ones and 404
+
+    Errors, including those flagged by `FixHttpStatusDownloaderMiddleware`, are not cached, so
+    that they are retried on the next run rather than replayed. With `HTTPCACHE_IGNORE_MISSING`
+    set too, a rerun never goes online.
+    """
+
+    def should_cache_response(self, response, request):
+        return (
+            200 <= response.status < 300 or response.status == 404
+        ) and super().should_cache_response(response, request)
@@ -86,6 +86,7 @@ class BookItem:
     of_category_id: Optional[str]  # searchType
     of_category_name: Optional[str]
     of_collection_name: str  # aid
+    crawled_at: Optional[str] = None  # in ISO 8601, for incremental crawls
 
 
 @mongo_item(collection_name="volumes", upsert_index=("id", "of_collection_name"))
@@ -3,12 +3,24 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import logging
+import math
+import time
+from urllib.parse import urlparse
+
 from scrapy import signals
+from scrapy.exceptions import NotConfigured
 from scrapy.spidermiddlewares.httperror import HttpError
+from twisted.internet import task
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+logger = logging.getLogger(__name__)
+
+# flags responses found to be "系统内部错误" by FixHttpStatusDownloaderMiddleware
+INTERNAL_ERROR_FLAG = "internal_error"
+
 
 class FixHttpStatusDownloaderMiddleware:
     @classmethod
@@ -23,8 +35,194 @@ class FixHttpStatusDownloaderMiddleware:
             and b"nlc.cn" not in response.body
         ):
             response.status = 500
+            response.flags.append(INTERNAL_ERROR_FLAG)
+        return response
+
+
+class EndpointClass:
+    def __init__(self, name, target_concurrency):
+        self.name = name
+        self.target_concurrency = target_concurrency
+        self.max_concurrency = max(1, math.ceil(target_concurrency))
+        self.slots = set()  # keys of download slots initialized
+        self.successes = 0  # since the concurrency was last changed
+        # since last logged
+        self.responses = 0
+        self.bytes = 0
+        self.latency = 0.0
+        self.errors = 0
+
+
+class EndpointThrottleDownloaderMiddleware:
+    """Throttle each class of endpoints apart, in place of AutoThrottle
+
+    Requests are put in a download slot per host and endpoint class, e.g. the cheap catalog
+    JSON apart from the heavy detail pages, whose delay is adjusted by latency as AutoThrottle
+    does, towards `ENDPOINT_THROTTLE_TARGET_CONCURRENCY` of the class. On "系统内部错误", the
+    delay of the class is multiplied by `ENDPOINT_THROTTLE_BACKOFF` and its concurrency is
+    dropped to 1, to be regained one by one after every `ENDPOINT_THROTTLE_RECOVERY` successes.
+    Throughput per class is logged every `ENDPOINT_THROTTLE_LOG_INTERVAL` seconds.
+
+    It should come after `FixHttpStatusDownloaderMiddleware`, i.e. with a smaller order.
+    """
+
+    # by path prefixes, in the order of the crawl
+    ENDPOINT_CLASSES = {
+        "/allSearch/searchList": "list",
+        "/allSearch/searchDetail": "detail",
+        "/OutOpenBook/OpenObjectBook": "reader",
+        "/allSearch/openBookPic": "image_list",
+        "/allSearch/formatCatalog": "toc",
+    }
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool("ENDPOINT_THROTTLE_ENABLED"):
+            raise NotConfigured
+        if settings.getbool("AUTOTHROTTLE_ENABLED"):
+            logger.warning(
+                "AutoThrottle is enabled too, which adjusts the same delays. Disable it."
+            )
+        self.crawler = crawler
+        target_concurrency = settings.getdict("ENDPOINT_THROTTLE_TARGET_CONCURRENCY")
+        self.classes = {
+            name: EndpointClass(name, float(target_concurrency.get(name, 1.0)))
+            for name in self.ENDPOINT_CLASSES.values()
+        }
+        self.min_delay = settings.getfloat("DOWNLOAD_DELAY")
+        self.start_delay = max(
+            self.min_delay, settings.getfloat("ENDPOINT_THROTTLE_START_DELAY", 5.0)
+        )
+        self.max_delay = settings.getfloat("ENDPOINT_THROTTLE_MAX_DELAY", 60.0)
+        self.backoff = settings.getfloat("ENDPOINT_THROTTLE_BACKOFF", 4.0)
+        self.recovery = settings.getint("ENDPOINT_THROTTLE_RECOVERY", 10)
+        self.log_interval = settings.getfloat("ENDPOINT_THROTTLE_LOG_INTERVAL", 60.0)
+        self.log_task = None
+        self.last_logged = time.monotonic()
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        self.last_logged = time.monotonic()
+        if self.log_interval > 0:
+            self.log_task = task.LoopingCall(self.log_throughput)
+            self.log_task.start(self.log_interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.log_task is not None and self.log_task.running:
+            self.log_task.stop()
+        self.log_throughput()
+
+    def classify(self, request):
+        path = urlparse(request.url).path
+        for prefix, name in self.ENDPOINT_CLASSES.items():
+            if path.startswith(prefix):
+                return self.classes[name]
+        return None
+
+    def get_slot(self, request, endpoint):
+        """The download slot of a request, initialized for its class once it exists"""
+        key = request.meta["download_slot"]
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is not None and key not in endpoint.slots:
+            endpoint.slots.add(key)
+            slot.delay = self.start_delay
+            slot.concurrency = endpoint.max_concurrency
+        return slot
+
+    def process_request(self, request, spider):
+        endpoint = self.classify(request)
+        # slots set by others are kept, while those set here may be copied along with the meta
+        # of responses to requests of other classes
+        if endpoint is None or (
+            "download_slot" in request.meta and "endpoint_class" not in request.meta
+        ):
+            return None
+        request.meta["download_slot"] = (
+            f"{urlparse(request.url).hostname}:{endpoint.name}"
+        )
+        request.meta["endpoint_class"] = endpoint.name
+        # the slot is created by the downloader after this, so only from the second request on
+        self.get_slot(request, endpoint)
+        return None
+
+    def process_response(self, request, response, spider):
+        endpoint = self.classes.get(request.meta.get("endpoint_class"))
+        latency = request.meta.get("download_latency")
+        if endpoint is None or latency is None or "cached" in response.flags:
+            return response
+        slot = self.get_slot(request, endpoint)
+        if slot is None:
+            return response
+        endpoint.responses += 1
+        endpoint.bytes += len(response.body)
+        endpoint.latency += latency
+
+        if INTERNAL_ERROR_FLAG in response.flags:
+            endpoint.errors += 1
+            endpoint.successes = 0
+            slot.delay = min(
+                max(slot.delay, self.start_delay) * self.backoff, self.max_delay
+            )
+            slot.concurrency = 1
+            logger.info(
+                f"Backing off {endpoint.name} to {slot.delay:.1f}s delay on internal error"
+            )
+            return response
+
+        # as AutoThrottle
+        target_delay = latency / endpoint.target_concurrency
+        new_delay = max(target_delay, (slot.delay + target_delay) / 2)
+        new_delay = min(max(self.min_delay, new_delay), self.max_delay)
+        # error pages are usually small and fast, which must not reduce the delay
+        if response.status == 200 or new_delay > slot.delay:
+            slot.delay = new_delay
+        if response.status < 500:
+            endpoint.successes += 1
+            if (
+                endpoint.successes >= self.recovery
+                and slot.concurrency < endpoint.max_concurrency
+            ):
+                slot.concurrency += 1
+                endpoint.successes = 0
         return response
 
+    def log_throughput(self):
+        downloader = self.crawler.engine.downloader
+        now = time.monotonic()
+        elapsed = max(now - self.last_logged, 1e-9)
+        self.last_logged = now
+        for endpoint in self.classes.values():
+            slots = [
+                slot
+                for key in endpoint.slots
+                if (slot := downloader.slots.get(key)) is not None
+            ]
+            if not endpoint.responses:
+                continue
+            mean_latency = endpoint.latency / max(endpoint.responses, 1)
+            logger.info(
+                f"{endpoint.name}: {endpoint.responses / elapsed * 60:.1f} responses/min,"
+                f" {endpoint.bytes / elapsed / 1024:.1f} KiB/s,"
+                f" latency {mean_latency:.2f}s, {endpoint.errors} internal errors,"
+                f" delay {', '.join(f'{slot.delay:.2f}s' for slot in slots) or '-'},"
+                f" concurrency {', '.join(str(slot.concurrency) for slot in slots) or '-'}"
+            )
+            stats = self.crawler.stats
+            stats.inc_value(
+                f"endpoint_throttle/{endpoint.name}/responses", endpoint.responses
+            )
+            stats.inc_value(f"endpoint_throttle/{endpoint.name}/bytes", endpoint.bytes)
+            stats.inc_value(
+                f"endpoint_throttle/{endpoint.name}/internal_errors", endpoint.errors
+            )
+            endpoint.responses = endpoint.bytes = endpoint.errors = 0
+            endpoint.latency = 0.0
+
 
 class NlccrawlerSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -15,6 +15,7 @@ from itemadapter import ItemAdapter
 # Adapted from: https://github.com/Gowee/NEMUserCrawler/blob/9f0cc86933937bb965e561523f40962a8eb2a9fc/NEMUserCrawler/pipelines.py
 
 import logging
+import time
 from urllib.parse import urlparse
 import txmongo
 from pymongo.uri_parser import parse_uri
@@ -27,16 +28,25 @@ from pymongo import InsertOne, UpdateOne
 class TxMongoPipeline(object):
     mongo_uri = "mongodb://localhost:27017"  # default
 
-    def __init__(self, mongo_uri, db_name, buffer_size=0):
+    def __init__(self, mongo_uri, db_name, buffer_size=0, buffer_max_age=0, stats=None):
         self.logger = logging.getLogger(self.__class__.__name__)
 
         self.mongo_uri = mongo_uri or self.mongo_uri
         self.db_name = db_name or parse_uri(self.mongo_uri)["database"]
 
         self.buffer_size = buffer_size
+        # seconds after which buffered operations are flushed however few, 0 for never
+        self.buffer_max_age = buffer_max_age
         if buffer_size > 0:
             self.buffer = {}
             self.buffer_count = 0
+            self.flush_timer = None
+            # held while flushing, so that items wait for the bulk write in flight
+            self.flush_lock = defer.DeferredLock()
+
+        self.stats = stats
+        self.collections_written = set()
+        self.opened_at = time.monotonic()
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -44,6 +54,8 @@ class TxMongoPipeline(object):
             mongo_uri=crawler.settings.get("MONGO_URI"),
             db_name=crawler.settings.get("MONGO_DB"),
             buffer_size=crawler.settings.getint("MONGO_BUFFER_SIZE", 0),
+            buffer_max_age=crawler.settings.getfloat("MONGO_BUFFER_MAX_AGE", 0),
+            stats=crawler.stats,
         )
 
     @defer.inlineCallbacks
@@ -64,10 +76,11 @@ class TxMongoPipeline(object):
             self.logger.error(e)
             raise NotConfigured(e)
         self.logger.info(
-            "TxMongoPipeline activated, uri: {}, database: {}, buffer size: {}.".format(
-                self.mongo_uri, self.db_name, self.buffer_size
+            "TxMongoPipeline activated, uri: {}, database: {}, buffer size: {}, buffer max age: {}s.".format(
+                self.mongo_uri, self.db_name, self.buffer_size, self.buffer_max_age
             )
         )
+        self.opened_at = time.monotonic()
         # https://github.com/twisted/txmongo/issues/236
         self.connection = yield txmongo.connection.ConnectionPool(
             self.mongo_uri,
@@ -79,8 +92,10 @@ class TxMongoPipeline(object):
 
     @defer.inlineCallbacks
     def close_spider(self, spider):
-        if hasattr(self, "buffer") and self.buffer:
+        if hasattr(self, "buffer"):
+            # after any flush in flight
             yield self.flush_buffer()
+        self.report_throughput()
         if self.connection:
             yield self.connection.disconnect()
 
@@ -109,18 +124,28 @@ class TxMongoPipeline(object):
         # TODO: test error handling
         if self.buffer_size:
             # buffer enabled
+            if self.flush_lock.locked:
+                # backpressure, holding up the crawl while a bulk write is in flight
+                yield self.flush_lock.acquire()
+                self.flush_lock.release()
+            operation = (
+                UpdateOne(upsert_spec, {"$set": processed_item}, upsert=True)
+                if upsert_spec
+                else InsertOne(processed_item)
+            )
+            self.buffer.setdefault(collection_name, []).append(operation)
+            self.buffer_count += 1
             if self.buffer_count >= self.buffer_size:
                 result = yield self.flush_buffer()
-            else:
-                operation = (
-                    UpdateOne(upsert_spec, {"$set": processed_item}, upsert=True)
-                    if upsert_spec
-                    else InsertOne(processed_item)
+            elif self.buffer_max_age > 0 and self.flush_timer is None:
+                from twisted.internet import reactor
+
+                self.flush_timer = reactor.callLater(
+                    self.buffer_max_age, self.flush_buffer_on_timer
                 )
-                self.buffer.setdefault(collection_name, []).append(operation)
-                self.buffer_count += 1
         else:
             # buffer disabled
+            started = time.monotonic()
             if upsert_spec:
                 # TODO: retry manually on error since scrapy won't do so for pipelines
                 result = yield self.db[collection_name].update(
@@ -137,6 +162,7 @@ class TxMongoPipeline(object):
                         )
                     )
                     result = e
+            self.record_write(collection_name, 1, time.monotonic() - started)
         spider.crawler.stats.inc_value(
             "pipeline/txmongo/{}".format(collection_name), spider=spider
         )
@@ -145,23 +171,78 @@ class TxMongoPipeline(object):
     @defer.inlineCallbacks
     def flush_buffer(self):
         results = []
-        buffer = (
-            self.buffer.copy()
-        )  # execution flow switched to other coroutines when bulk write
-        self.buffer.clear()
-        self.buffer_count = 0
-        for collection_name, operations in buffer.items():
-            try:
-                result = yield self.db[collection_name].bulk_write(
-                    operations, ordered=False
-                )
-                self.logger.debug(
-                    "Buffer flushed, {} for collection {}: {}".format(
-                        len(operations), collection_name, result.bulk_api_result
+        yield self.flush_lock.acquire()
+        try:
+            if self.flush_timer is not None:
+                if self.flush_timer.active():
+                    self.flush_timer.cancel()
+                self.flush_timer = None
+            buffer = (
+                self.buffer.copy()
+            )  # execution flow switched to other coroutines when bulk write
+            self.buffer.clear()
+            self.buffer_count = 0
+            for collection_name, operations in buffer.items():
+                started = time.monotonic()
+                try:
+                    result = yield self.db[collection_name].bulk_write(
+                        operations, ordered=False
+                    )
+                    self.logger.debug(
+                        "Buffer flushed, {} for collection {}: {}".format(
+                            len(operations), collection_name, result.bulk_api_result
+                        )
+                    )
+                except BulkWriteError as e:
+                    self.logger.error(
+                        "{!r} when writing buffer: {}".format(e, e.details)
                     )
+                    result = e.details
+                    results.append(result)
+                self.record_write(
+                    collection_name, len(operations), time.monotonic() - started
                 )
-            except BulkWriteError as e:
-                self.logger.error("{!r} when writing buffer: {}".format(e, e.details))
-                result = e.details
-                results.append(result)
+        finally:
+            self.flush_lock.release()
         defer.returnValue(results)
+
+    def flush_buffer_on_timer(self):
+        self.flush_buffer().addErrback(
+            lambda failure: self.logger.error(
+                "Failed to flush buffer on timer: {!r}".format(failure.value),
+                exc_info=(failure.type, failure.value, failure.getTracebackObject()),
+            )
+        )
+
+    def record_write(self, collection_name, ops, latency):
+        if self.stats is None:
+            return
+        self.collections_written.add(collection_name)
+        prefix = "pipeline/txmongo/{}/".format(collection_name)
+        self.stats.inc_value(prefix + "writes")
+        self.stats.inc_value(prefix + "ops", ops)
+        self.stats.inc_value(prefix + "write_seconds", latency)
+        self.stats.max_value(prefix + "max_write_seconds", latency)
+
+    def report_throughput(self):
+        if self.stats is None:
+            return
+        elapsed = max(time.monotonic() - self.opened_at, 1e-9)
+        for collection_name in sorted(self.collections_written):
+            prefix = "pipeline/txmongo/{}/".format(collection_name)
+            ops = self.stats.get_value(prefix + "ops", 0)
+            writes = self.stats.get_value(prefix + "writes", 0)
+            write_seconds = self.stats.get_value(prefix + "write_seconds", 0)
+            self.stats.set_value(prefix + "ops_per_sec", ops / elapsed)
+            self.stats.set_value(
+                prefix + "mean_write_seconds", write_seconds / max(writes, 1)
+            )
+            self.logger.info(
+                "{}: {} ops in {} writes, {:.1f} ops/s, {:.3f}s per write".format(
+                    collection_name,
+                    ops,
+                    writes,
+                    ops / elapsed,
+                    write_seconds / max(writes, 1),
+                )
+            )
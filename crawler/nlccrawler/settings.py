@@ -53,6 +53,7 @@ ROBOTSTXT_OBEY = True
 DOWNLOADER_MIDDLEWARES = {
     #    'nlccrawler.middlewares.NlccrawlerDownloaderMiddleware': 543,
     "nlccrawler.middlewares.FixHttpStatusDownloaderMiddleware": 990,
+    "nlccrawler.middlewares.EndpointThrottleDownloaderMiddleware": 980,
 }
 
 # Enable or disable extensions
@@ -70,7 +71,8 @@ ITEM_PIPELINES = {
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
-AUTOTHROTTLE_ENABLED = True
+# superseded by the per-endpoint throttling below
+AUTOTHROTTLE_ENABLED = False
 # The initial download delay
 AUTOTHROTTLE_START_DELAY = 5
 # The maximum download delay to be set in case of high latencies
@@ -81,12 +83,33 @@ AUTOTHROTTLE_TARGET_CONCURRENCY = 1.0
 # Enable showing throttling stats for every response received:
 # AUTOTHROTTLE_DEBUG = False
 
+# Throttle list pages, detail pages, readers, image lists and catalogs apart, each adjusted by
+# its own latency and backing off sharply on "系统内部错误"
+ENDPOINT_THROTTLE_ENABLED = True
+ENDPOINT_THROTTLE_START_DELAY = 5
+ENDPOINT_THROTTLE_MAX_DELAY = 60
+ENDPOINT_THROTTLE_TARGET_CONCURRENCY = {
+    "list": 1.0,
+    "detail": 1.0,
+    "reader": 1.0,
+    "image_list": 1.0,
+    "toc": 4.0,  # small JSON
+}
+# ENDPOINT_THROTTLE_BACKOFF = 4
+# ENDPOINT_THROTTLE_RECOVERY = 10
+# ENDPOINT_THROTTLE_LOG_INTERVAL = 60
+
 # Enable and configure HTTP caching (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
 # HTTPCACHE_ENABLED = True
 # HTTPCACHE_EXPIRATION_SECS = 0
 # HTTPCACHE_DIR = 'httpcache'
 # HTTPCACHE_IGNORE_HTTP_CODES = []
-# HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
+# Enabled with `-s HTTPCACHE_ENABLED=1`, responses are kept compressed in a single database.
+# Reruns, e.g. after fixing parsers, are served from it. Add `-s HTTPCACHE_IGNORE_MISSING=1` to
+# keep them offline.
+HTTPCACHE_STORAGE = "nlccrawler.httpcache.SqliteZstdCacheStorage"
+HTTPCACHE_POLICY = "nlccrawler.httpcache.ReplayPolicy"
+# HTTPCACHE_ZSTD_LEVEL = 3
 
 RETRY_TIMES = 9
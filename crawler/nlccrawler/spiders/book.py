@@ -6,6 +6,7 @@ from itertools import chain
 from copy import copy
 
 from ..items import BookItem, VolumeItem, PageItem
+from ..crawlindex import CrawlIndex, brief_hash, now, ttl_of_days
 
 
 class BookSpider(scrapy.Spider):
@@ -18,6 +19,11 @@ class BookSpider(scrapy.Spider):
     URL_VOLUME_IMAGE_LIST = "http://read.nlc.cn/allSearch/openBookPic?id={volume_id}&l_id={date}&indexName={collection_name}"
 
     REGEX_PDFNAME_IN_READER = re.compile(r"var pdfname= '(.+?)';")
+    # e.g. "共 123 页" in the pager, without which pages are requested in doubling windows
+    REGEX_PAGE_COUNT_IN_LIST = re.compile(r"共\s*(\d+)\s*页")
+
+    # pages requested past the end of a list are at most as many
+    MAX_LIST_PAGE_WINDOW = 64
 
     PRIO_LIST_PAGE = 10
     PRIO_BOOK_INFO = 20
@@ -30,6 +36,8 @@ class BookSpider(scrapy.Spider):
         end_page=0,  # inclusive
         no_book=False,
         no_volume=False,
+        incremental=None,  # "mongo", or the path of a local index file
+        ttl=None,  # in days, after which books are crawled again in incremental crawls
         *args,
         **kwargs,
     ):
@@ -40,18 +48,79 @@ class BookSpider(scrapy.Spider):
         assert self.start_page <= self.end_page or self.end_page == 0
         self.no_book = no_book
         self.no_volume = no_volume
+        self.incremental = incremental
+        self.ttl = ttl_of_days(ttl)
+        self.index = None
+        # (of_collection_name, id) -> [volumes left, brief hash, crawled at]
+        self.pending_books = {}
+        # list pages are requested independently rather than one after another, up to the
+        # page count if it is known, or else in windows doubling in size
+        self.page_count = None
+        self.scheduled_until = self.start_page
+        self.exhausted_from = None  # the first page found empty or missing
 
     def start_requests(self):
-        yield scrapy.Request(
-            self.URL_LIST_PAGE.format(category=self.category, page=self.start_page),
-            meta={"page": self.start_page},
-            dont_filter=True,
+        if self.incremental == "mongo":
+            self.index = CrawlIndex.from_mongo(
+                self.settings.get("MONGO_URI"), self.settings.get("MONGO_DB"), self.ttl
+            )
+        elif self.incremental:
+            self.index = CrawlIndex.from_file(self.incremental, self.ttl)
+        yield self.list_page_request(self.start_page, dont_filter=True)
+
+    def list_page_request(self, page, **kwargs):
+        return scrapy.Request(
+            self.URL_LIST_PAGE.format(category=self.category, page=page),
+            meta={"page": page, "handle_httpstatus_list": [404]},
+            priority=self.PRIO_LIST_PAGE,
             callback=self.parse_list_page,
+            errback=self.list_page_failed,
+            **kwargs,
         )
 
+    def list_page_failed(self, failure):
+        page = failure.request.meta["page"]
+        if page == self.scheduled_until:
+            # no telling whether the list ends here, so leave it to be resumed from here
+            self.log(
+                f"List page {page} failed, no more pages requested after it: {failure.value!r}",
+                logging.WARNING,
+            )
+        else:
+            self.log(f"List page {page} failed: {failure.value!r}", logging.WARNING)
+
+    def schedule_list_pages(self, response, page):
+        """Request the next list pages once the last one requested turns out non-empty"""
+        if page != self.scheduled_until:
+            return
+        if self.end_page > 0 and page >= self.end_page:
+            return
+        if page == self.start_page and (
+            match := self.REGEX_PAGE_COUNT_IN_LIST.search(response.text)
+        ):
+            self.page_count = int(match[1])
+            self.log(f"Category {self.category} has {self.page_count} list pages")
+        if self.page_count is not None and page < self.page_count:
+            until = self.page_count
+        elif self.page_count is not None:
+            until = page + 1  # just in case the count has been outdated
+        else:
+            until = page + min(page - self.start_page + 1, self.MAX_LIST_PAGE_WINDOW)
+        if self.end_page > 0:
+            until = min(until, self.end_page)
+        if self.exhausted_from is not None:
+            until = min(until, self.exhausted_from - 1)
+        self.log(f"Requesting list pages {page + 1}..{until}", logging.DEBUG)
+        for next_page in range(page + 1, until + 1):
+            yield self.list_page_request(next_page)
+        self.scheduled_until = max(until, page)
+
     def parse_list_page(self, response):
-        # TODO: terminate on 404
         page = response.meta["page"]
+        if response.status == 404:
+            self.log(f"List page {page} not found", logging.INFO)
+            self.exhausted_from = min(self.exhausted_from or page, page)
+            return
 
         category_name = response.css("input#categoryName").attrib["value"]
         books_in_page = []
@@ -80,6 +149,7 @@ class BookSpider(scrapy.Spider):
                 continue
             # TODO: filter out placeholder cover image
             cover_image_url = book.css("img::attr(src)").get()
+            hash = brief_hash(title, brief)
 
             books_in_page.append(
                 {
@@ -89,7 +159,11 @@ class BookSpider(scrapy.Spider):
                     "of_collection_name": collection_name,
                 }
             )
-            if not self.no_book:
+            if self.index is not None and self.index.is_fresh(
+                collection_name, book_id, hash
+            ):
+                self.crawler.stats.inc_value("incremental/books_skipped")
+            elif not self.no_book:
                 yield response.follow(
                     url,
                     meta={
@@ -97,6 +171,7 @@ class BookSpider(scrapy.Spider):
                         "page": page,
                         "book_id": book_id,
                         "cover_image_url": cover_image_url,
+                        "brief_hash": hash,
                     },
                     priority=self.PRIO_BOOK_INFO,
                     callback=self.parse_book_info,
@@ -111,15 +186,9 @@ class BookSpider(scrapy.Spider):
                 of_category_id=self.category,
                 of_category_name=category_name,
             )
-            if self.end_page > 0 and page == self.end_page:
-                return
-            page += 1
-            yield response.follow(
-                self.URL_LIST_PAGE.format(category=self.category, page=page),
-                meta={"page": page},
-                priority=self.PRIO_LIST_PAGE,
-                callback=self.parse_list_page,
-            )
+            yield from self.schedule_list_pages(response, page)
+        else:
+            self.exhausted_from = min(self.exhausted_from or page, page)
 
     def parse_book_info(self, response):
         page = response.meta["page"]
@@ -272,6 +341,14 @@ class BookSpider(scrapy.Spider):
                     )
             volumes.append((volume_id, volume_name))
 
+        crawled_at = now()
+        if self.index is not None:
+            self.pending_books[collection_name, book_id] = [
+                0 if self.no_volume else len(volumes),
+                response.meta["brief_hash"],
+                crawled_at,
+            ]
+            self.volume_crawled(collection_name, book_id, 0)
         yield BookItem(
             id=book_id,
             name=title,
@@ -284,8 +361,28 @@ class BookSpider(scrapy.Spider):
             keywords=keywords,
             misc_metadata=misc_metadata,
             volumes=volumes,
+            crawled_at=crawled_at,
         )
 
+    def volume_crawled(self, collection_name, book_id, count=1):
+        """Add a book to the index once all of its volumes are crawled, so that books
+        interrupted halfway are crawled again"""
+        pending = self.pending_books.get((collection_name, book_id))
+        if pending is None:
+            return
+        pending[0] -= count
+        if pending[0] <= 0:
+            del self.pending_books[collection_name, book_id]
+            self.index.add(collection_name, book_id, pending[1], pending[2])
+
+    def closed(self, reason):
+        if self.index is not None:
+            self.log(
+                f"{self.crawler.stats.get_value('incremental/books_skipped', 0)} books skipped"
+                f" as crawled before, {len(self.pending_books)} left with volumes uncrawled"
+            )
+            self.index.close()
+
     def parse_volume_reader(self, response):
         volume_id = response.meta["volume_id"]
         try:
@@ -364,6 +461,8 @@ class BookSpider(scrapy.Spider):
             if chapter[0] or chapter[1]:
                 toc.append(chapter)
 
+        if self.index is not None:
+            self.volume_crawled(collection_name, book_id)
         yield VolumeItem(
             id=volume_id,
             name=volume_name,
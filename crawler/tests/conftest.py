@@ -0,0 +1,5 @@
+# for `nlccrawler` to be importable without installing the project
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
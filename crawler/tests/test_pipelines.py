@@ -0,0 +1,178 @@
+from types import SimpleNamespace
+
+import pytest
+import twisted.internet
+from pymongo import UpdateOne
+from scrapy.statscollectors import MemoryStatsCollector
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer, task
+
+from nlccrawler.items import CategoryItem, PageItem
+from nlccrawler.pipelines import TxMongoPipeline
+
+
+class FakeCollection:
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def bulk_write(self, operations, ordered=True):
+        self.db.writes.append((self.name, list(operations)))
+        result = SimpleNamespace(bulk_api_result={"nUpserted": len(operations)})
+        if self.db.hold:
+            self.db.held = defer.Deferred()
+            return self.db.held.addCallback(lambda _: result)
+        return defer.succeed(result)
+
+
+class FakeDb:
+    """Record bulk writes, which complete at once, or only when `held` is fired with `hold`"""
+
+    def __init__(self):
+        self.writes = []
+        self.hold = False
+        self.held = None
+
+    def __getitem__(self, name):
+        return FakeCollection(self, name)
+
+
+class FakeCrawler:
+    def __init__(self, stats):
+        self.stats = stats
+
+
+class FakeSpider:
+    name = "fake"
+
+    def __init__(self, stats):
+        self.crawler = FakeCrawler(stats)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = task.Clock()
+    # as the pipeline imports the reactor when scheduling a flush
+    monkeypatch.setattr(twisted.internet, "reactor", clock, raising=False)
+    return clock
+
+
+def make_pipeline(**kwargs):
+    stats = MemoryStatsCollector(get_crawler())
+    pipeline = TxMongoPipeline("mongodb://localhost/test", None, stats=stats, **kwargs)
+    pipeline.db = FakeDb()
+    pipeline.connection = None
+    return pipeline, FakeSpider(stats)
+
+
+def category(i):
+    return CategoryItem(i, f"category {i}", "data_1", "", "", "")
+
+
+def page(i):
+    return PageItem(i, 1, "data_1", [])
+
+
+def process(pipeline, spider, item):
+    results = []
+    pipeline.process_item(item, spider).addCallback(results.append)
+    return results
+
+
+def ops(pipeline):
+    return [len(operations) for _, operations in pipeline.db.writes]
+
+
+def test_flushes_when_full_including_the_last_item(clock):
+    pipeline, spider = make_pipeline(buffer_size=3)
+    for i in range(5):
+        assert process(pipeline, spider, category(i)) == [category(i)]
+    assert ops(pipeline) == [3]
+    name, operations = pipeline.db.writes[0]
+    assert name == "categories"
+    assert all(isinstance(op, UpdateOne) for op in operations)
+
+    pipeline.close_spider(spider)
+    assert ops(pipeline) == [3, 2]
+    stats = spider.crawler.stats
+    assert stats.get_value("pipeline/txmongo/categories/ops") == 5
+    assert stats.get_value("pipeline/txmongo/categories/writes") == 2
+    assert stats.get_value("pipeline/txmongo/categories") == 5
+
+
+def test_flushes_per_collection(clock):
+    pipeline, spider = make_pipeline(buffer_size=3)
+    process(pipeline, spider, category(1))
+    process(pipeline, spider, page(1))
+    process(pipeline, spider, category(2))
+    assert sorted(
+        (name, len(operations)) for name, operations in pipeline.db.writes
+    ) == [
+        ("categories", 2),
+        ("pages", 1),
+    ]
+    pages = dict(pipeline.db.writes)["pages"]
+    assert isinstance(pages[0], UpdateOne)
+
+
+def test_holds_items_while_flushing(clock):
+    pipeline, spider = make_pipeline(buffer_size=2)
+    pipeline.db.hold = True
+    process(pipeline, spider, category(1))
+    process(pipeline, spider, category(2))
+    assert ops(pipeline) == [2]
+
+    # backpressure, until the bulk write in flight completes
+    waiting = process(pipeline, spider, category(3))
+    assert waiting == []
+    assert pipeline.buffer_count == 0
+
+    pipeline.db.hold = False
+    pipeline.db.held.callback(None)
+    assert waiting == [category(3)]
+    assert pipeline.buffer_count == 1
+
+
+def test_flushes_on_timer(clock):
+    pipeline, spider = make_pipeline(buffer_size=100, buffer_max_age=5)
+    process(pipeline, spider, category(1))
+    clock.advance(3)
+    process(pipeline, spider, category(2))
+    assert ops(pipeline) == []
+    # counted from the oldest item buffered
+    clock.advance(2)
+    assert ops(pipeline) == [2]
+    assert not clock.getDelayedCalls()
+
+    process(pipeline, spider, category(3))
+    pipeline.close_spider(spider)
+    # the timer is cancelled along with the flush
+    assert ops(pipeline) == [2, 1]
+    assert not clock.getDelayedCalls()
+
+
+def test_writes_at_once_without_buffer(clock):
+    class Collection:
+        def __init__(self):
+            self.inserted = []
+
+        def insert_one(self, document):
+            self.inserted.append(document)
+            return defer.succeed(None)
+
+    pipeline, spider = make_pipeline()
+    collection = Collection()
+    pipeline.db = {"categories": collection}
+    item = category(1)
+    item._upsert_index = None
+    assert process(pipeline, spider, item) == [item]
+    assert collection.inserted == [
+        {
+            "_id": 1,
+            "name": "category 1",
+            "collection_name": "data_1",
+            "description": "",
+            "icon_url": "",
+            "parental_category_name": "",
+        }
+    ]
@@ -9,27 +9,12 @@ import functools
 import mwclient
 from more_itertools import peekable
 
+from normalize import fix_bookname_in_pagename
+
 CONFIG_FILE_PATH = os.path.join(os.path.dirname(__file__), "config.yml")
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 
 
-def fix_bookname_in_pagename(
-    bookname, apply_tortoise_shell_brackets_to_starting_of_title=False
-):
-    # if bookname.startswith("[") and bookname.endswith("]"):  # [四家四六]
-    #     bookname = bookname[1:-1]
-
-    if apply_tortoise_shell_brackets_to_starting_of_title and bookname.startswith("["):
-        bookname = re.sub(r"\[(.+?)\]", r"〔\1〕", bookname)  # [宋]...
-    bookname = re.sub(r"\[(.+?)\]", r"\1", bookname)
-    bookname = bookname.replace(":", "：")  # e.g. 404 00J001624 綠洲:中英文藝綜合月刊
-    bookname = re.sub(r"\s+", " ", bookname)
-    bookname = bookname.replace(
-        "?", "□"
-    )  # WHITE SQUARE, U+25A1, for, e.g. 892 312001039388 筠清?金石文字   五卷"
-    return bookname
-
-
 def main():
     with open(CONFIG_FILE_PATH, "r") as f:
         config = yaml.safe_load(f.read())
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Benchmark rendering the placeholder pages of broken image URLs
+
+The rendering in `getbook.py` is compared against the per-call font loading and QR code
+rendering it replaced, which is kept here as the reference. Its QR codes are checked to be
+identical, module by module, to the ones of qrcode's own renderer with the same mask pattern.
+"""
+
+import datetime
+import sys
+import textwrap
+import time
+from datetime import timezone
+from io import BytesIO
+from urllib.parse import quote as urlquote
+
+from PIL import Image, ImageChops, ImageFont
+from qrcode import QRCode
+
+import getbook
+
+URL = "http://read.nlc.cn/menhu/OutOpenBook/getReader?aid=892&bid={bid}.0&page={page}"
+
+
+def legacy_construct_failure_page(url, page_name=""):
+    qr = QRCode(box_size=3)
+    qr.add_data(url)
+    qr.make()
+    qr_img = qr.make_image().get_image()
+
+    font = ImageFont.truetype(str(getbook.FONT_FILE_PATH), size=20)
+
+    t = datetime.datetime.now(timezone.utc)
+    if page_name:
+        page_name = " " + page_name
+    texts = [
+        f"The page{page_name} links to an broken url:",
+        *textwrap.wrap(urlquote(url, safe=":/"), break_on_hyphens=False),
+        "Access time: " + str(t),
+    ]
+
+    margin = (5, 5)
+    spacing = 3
+    mask_images = [font.getmask(text, "L") for text in texts]
+    width = (
+        max(max(mask_image.size[0] for mask_image in mask_images), qr_img.size[0])
+        + margin[0] * 2
+    )
+    height = (
+        sum(mask_image.size[1] for mask_image in mask_images)
+        + margin[1] * 2
+        + (len(mask_images) - 1) * spacing
+        + spacing
+        + qr_img.size[1]
+    )
+    img = Image.new("RGB", (width, height), (255, 255, 255))
+    y = margin[1]
+    for mask_image in mask_images:
+        img.im.paste(
+            (0, 0, 0),
+            (margin[0], y, margin[0] + mask_image.size[0], y + mask_image.size[1]),
+            mask_image,
+        )
+        y += mask_image.size[1] + spacing
+    img.paste(qr_img, (0, y))
+
+    output = BytesIO()
+    img.save(output, format="JPEG")
+    return output.getvalue()
+
+
+def reference_qr(url):
+    qr = QRCode(
+        box_size=getbook.FAILURE_PAGE_QR_BOX_SIZE,
+        mask_pattern=getbook.FAILURE_PAGE_QR_MASK_PATTERN,
+    )
+    qr.add_data(url)
+    qr.make()
+    return qr.make_image().get_image().convert("L")
+
+
+def timed(fn, calls):
+    start = time.perf_counter()
+    for args in calls:
+        fn(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    # as for a volume of many broken pages, with page names repeating across volumes
+    calls = [
+        (URL.format(bid=bid, page=page), str(page))
+        for bid in range(count // 100 + 1)
+        for page in range(1, 101)
+    ][:count]
+
+    mismatches = [
+        url
+        for url, _ in calls[:20]
+        if ImageChops.difference(
+            getbook.failure_page_qr(url), reference_qr(url)
+        ).getbbox()
+    ]
+    for url in mismatches:
+        print(f"  QR code mismatch: {url}")
+
+    legacy_time = timed(legacy_construct_failure_page, calls)
+    getbook.failure_page_font.cache_clear()
+    getbook.failure_page_glyph.cache_clear()
+    cached_time = timed(getbook.construct_failure_page, calls)
+    print(
+        f"construct_failure_page: {len(calls)} pages, "
+        f"legacy {legacy_time / len(calls) * 1000:.2f}ms/page, "
+        f"cached {cached_time / len(calls) * 1000:.2f}ms/page "
+        f"({legacy_time / cached_time:.1f}x), "
+        f"{len(mismatches)} QR code mismatches"
+    )
+    if mismatches:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Benchmark the normalization of book names and bylines over all batches in data/
+
+The normalization in `normalize.py` is checked for parity against the regex-per-step
+implementation it replaced, which is kept here as the reference.
+"""
+
+import glob
+import json
+import os
+import re
+import sys
+import time
+
+import normalize
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+
+def legacy_fix_bookname_in_pagename(
+    bookname, apply_tortoise_shell_brackets_to_starting_of_title=False
+):
+    if apply_tortoise_shell_brackets_to_starting_of_title and bookname.startswith("["):
+        bookname = re.sub(r"\[(.+?)\]", r"〔\1〕", bookname)  # [宋]...
+    bookname = re.sub(r"\[(.+?)\]", r"\1", bookname)
+    bookname = bookname.replace(":", "：")
+    bookname = bookname.replace("###", " ").replace("@@@", " ")
+    bookname = re.sub(r"\s+", " ", bookname)
+    bookname = bookname.replace("?", "□").replace("○", "〇")
+    bookname = re.sub(r"(?<=\d)\*(?=\d)", "×", bookname)
+    bookname = re.sub(r'"([^"]+)"', r"“\1”", bookname)
+    return bookname
+
+
+def legacy_format_byline(author, apply_tortoise_shell_brackets_to_starting_of_byline):
+    byline = author
+    byline_enclosing_brackets = False
+    if author.startswith("[") and author.endswith("]"):
+        byline = byline[1:-1]
+        byline_enclosing_brackets = True
+    if apply_tortoise_shell_brackets_to_starting_of_byline:
+        atsb = lambda s: re.sub(
+            r"^([（(〔[][题題][]）)〕])?[（(〔[](.{0,3}?)[]）)〕]",
+            r"\1〔\2〕",
+            s,
+        )
+    else:
+        atsb = lambda s: s
+    byline = re.sub(r"(（[^）]+?)(,)([^）]+?）)", "\\1\uf8ff\\3", byline)
+    byline = " <br />\n".join(
+        " ".join(atsb(aauthor) for aauthor in re.split(r"[，,、]", author))
+        for author in re.split(
+            r"@@@|###@@@|   ",
+            byline,
+        )
+    )
+    byline = byline.replace("\uf8ff", ",")
+    if byline_enclosing_brackets:
+        byline = "[" + byline + "]"
+    return byline
+
+
+def timed(fn, calls):
+    start = time.perf_counter()
+    results = [fn(*args) for args in calls]
+    return results, time.perf_counter() - start
+
+
+def bench(label, legacy, fused, calls):
+    expected, legacy_time = timed(legacy, calls)
+    fused.cache_clear()
+    actual, cold_time = timed(fused, calls)
+    _, warm_time = timed(fused, calls)
+    mismatches = [(args, e, a) for args, e, a in zip(calls, expected, actual) if e != a]
+    print(
+        f"{label}: {len(calls)} calls, legacy {legacy_time * 1000:.1f}ms, "
+        f"cold {cold_time * 1000:.1f}ms ({legacy_time / cold_time:.1f}x), "
+        f"warm {warm_time * 1000:.1f}ms ({legacy_time / warm_time:.1f}x), "
+        f"{len(mismatches)} mismatches"
+    )
+    for args, e, a in mismatches[:10]:
+        print(f"  {args!r}: {e!r} != {a!r}")
+    return not mismatches
+
+
+def main():
+    paths = sys.argv[1:] or sorted(glob.glob(os.path.join(DATA_DIR, "*.json")))
+    books = []
+    for path in paths:
+        with open(path) as f:
+            books.extend(json.load(f))
+    print(f"{len(books)} books from {len(paths)} batches")
+
+    # as called by upload.py: once per volume for filenames, and once per book for bylines
+    name_calls = [
+        (book["name"], apply)
+        for apply in (False, True)
+        for book in books
+        for _volume in book["volumes"]
+    ]
+    byline_calls = [
+        (book["author"], apply)
+        for apply in (False, True)
+        for book in books
+        if "\uf8ff" not in book["author"]
+    ]
+    ok = bench(
+        "fix_bookname_in_pagename",
+        legacy_fix_bookname_in_pagename,
+        normalize.fix_bookname_in_pagename,
+        name_calls,
+    )
+    ok &= bench(
+        "format_byline",
+        legacy_format_byline,
+        normalize.format_byline,
+        byline_calls,
+    )
+    if not ok:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,9 @@
 import sys, json, re, os, logging, traceback
 from itertools import count
 import functools
-import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from httppool import PooledSession
 
 LOGLEVEL = os.environ.get("LOGLEVEL", "INFO").upper()
 logging.basicConfig(level=LOGLEVEL)
@@ -12,6 +14,9 @@ FILE_URL = "http://read.nlc.cn/{server}{file_path}"
 
 VACANT_VOLUME_ID_STARTING = 999990015
 
+# probes for consecutive files go to the same server, so keep the connection alive
+session = PooledSession()
+
 
 def retry(times=3):
     def wrapper(fn):
@@ -96,7 +101,7 @@ def main():
                         next_file_path != first_file_path
                     ), f"Invalid first file_path: {', '.join(file_paths)}"
                     next_url = FILE_URL.format(server=server, file_path=next_file_path)
-                    if (_resp := retry(3)(requests.get)(next_url)).ok:
+                    if (_resp := retry(3)(session.get)(next_url)).ok:
                         logger.info(
                             f"New file found in {book['id']} {book['name']} ({nth} / {len(volumes)}): {next_file_path}, volume id {vacant_volume_id} used"
                         )
@@ -119,6 +124,7 @@ def main():
                 traceback.print_exc()
         # if inplace:
         logger.info(f"{vcnt} volumes {bcnt} books fixed in {f}")
+        logger.info(f"Connections: {session.stats()}")
         with open(f, "w") as file:
             json.dump(books, file, ensure_ascii=False, indent=2)
         with open(f.replace(".json", ".fixedmissing.json"), "w") as file:
@@ -0,0 +1,161 @@
+"""A content-addressed on-disk cache of downloaded volumes"""
+
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from getbook import Download
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """\
+CREATE TABLE IF NOT EXISTS entries (
+    collection TEXT NOT NULL,
+    volume_id TEXT NOT NULL,
+    file_path TEXT NOT NULL,
+    sha1 TEXT NOT NULL,
+    PRIMARY KEY (collection, volume_id, file_path)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    sha1 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs (last_used);
+"""
+
+UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(size):
+    """Parse sizes such as 1073741824, "500M" or "20G" into bytes"""
+    if isinstance(size, str) and size[-1:].upper() in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1].upper()])
+    return int(size)
+
+
+def cache_key(collection, volume_id, file_path):
+    if file_path is not None and not isinstance(file_path, str):
+        # image lists may consist of hundreds of urls
+        file_path = (
+            "sha1:" + hashlib.sha1("\n".join(file_path).encode("utf-8")).hexdigest()
+        )
+    return str(collection), str(volume_id), file_path or ""
+
+
+class DownloadCache:
+    """Maps (collection, volume id, file_path) to blobs named by their SHA-1
+
+    The total size of blobs is kept under `budget` bytes by evicting the least recently used
+    ones. Blobs are hard-linked into and out of spool files where possible, so neither hits nor
+    stores copy any data.
+    """
+
+    def __init__(self, directory, budget):
+        self.directory = Path(directory)
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        (self.directory / "blobs").mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            self.directory / "index.sqlite3",
+            timeout=60,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def blob_path(self, sha1):
+        return self.directory / "blobs" / sha1[:2] / sha1
+
+    def get(self, key, spool_path):
+        """Put the cached file for `key` at `spool_path`, returning None on miss"""
+        with self.lock:
+            row = self.conn.execute(
+                """SELECT blobs.sha1, blobs.size FROM entries JOIN blobs USING (sha1)
+                WHERE collection = ? AND volume_id = ? AND file_path = ?""",
+                key,
+            ).fetchone()
+            if row is not None:
+                sha1, size = row
+                try:
+                    _link_or_copy(self.blob_path(sha1), spool_path)
+                except FileNotFoundError:
+                    logger.warning(f"Blob {sha1} missing from download cache")
+                    self._forget(sha1)
+                    row = None
+                else:
+                    self.conn.execute(
+                        "UPDATE blobs SET last_used = ? WHERE sha1 = ?",
+                        (time.time(), sha1),
+                    )
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        logger.debug(f"Download cache hit for {key}: {sha1}")
+        return Download(Path(spool_path), size, sha1)
+
+    def put(self, key, download):
+        if download.size > self.budget:
+            return
+        blob_path = self.blob_path(download.sha1)
+        blob_path.parent.mkdir(exist_ok=True)
+        with self.lock:
+            if not blob_path.exists():
+                _link_or_copy(download.path, blob_path)
+            self.conn.execute(
+                """INSERT INTO blobs (sha1, size, last_used) VALUES (?, ?, ?)
+                ON CONFLICT (sha1) DO UPDATE SET last_used = excluded.last_used""",
+                (download.sha1, download.size, time.time()),
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                (*key, download.sha1),
+            )
+            self._evict()
+
+    def stats(self):
+        with self.lock:
+            blobs, size = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs"
+            ).fetchone()
+        return {"hits": self.hits, "misses": self.misses, "blobs": blobs, "size": size}
+
+    def _evict(self):
+        (total,) = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM blobs"
+        ).fetchone()
+        if total <= self.budget:
+            return
+        for sha1, size in self.conn.execute(
+            "SELECT sha1, size FROM blobs ORDER BY last_used"
+        ).fetchall():
+            logger.debug(f"Evicting {sha1} ({size} B) from download cache")
+            self.blob_path(sha1).unlink(missing_ok=True)
+            self._forget(sha1)
+            total -= size
+            if total <= self.budget:
+                break
+
+    def _forget(self, sha1):
+        self.conn.execute("DELETE FROM entries WHERE sha1 = ?", (sha1,))
+        self.conn.execute("DELETE FROM blobs WHERE sha1 = ?", (sha1,))
+
+
+def _link_or_copy(src, dst):
+    # never write through an existing link, which may share its inode with a blob
+    Path(dst).unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        if not Path(src).exists():
+            raise FileNotFoundError(src)
+        shutil.copyfile(src, dst)
@@ -0,0 +1,92 @@
+"""A local log of batch events, published to the wiki in batches"""
+
+import json
+import logging
+import threading
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class EventLog:
+    """Append events to a local JSONL file, and hand them over to `publish` in batches
+
+    Every event is written to `path` before `log` returns. A background thread calls
+    `publish(events)` once `flush_every` events are pending or `flush_interval` seconds have
+    passed since the last flush. Events failing to be published, with `publish` raising or
+    returning False, are kept for the next try, and are in the local file anyway.
+
+    With `publish` being None, events are only written locally.
+    """
+
+    def __init__(self, path, publish=None, flush_every=20, flush_interval=600):
+        self.path = path
+        self.publish = publish
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.closed = False
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.file = open(path, "a", encoding="utf-8")
+        self.thread = None
+        if publish is not None:
+            # daemonic so that a crashing batch still exits, at worst losing only the summary
+            self.thread = threading.Thread(
+                target=self._work, name="eventlog", daemon=True
+            )
+            self.thread.start()
+
+    def log(self, message, **fields):
+        event = {"time": str(datetime.now(timezone.utc)), "message": message} | fields
+        with self.lock:
+            self.file.write(json.dumps(event, ensure_ascii=False) + "\n")
+            self.file.flush()
+            if self.publish is None:
+                return
+            self.pending.append(event)
+            if len(self.pending) >= self.flush_every:
+                self.cond.notify()
+
+    def close(self):
+        """Publish all pending events and stop the flusher"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+        self.file.close()
+
+    def _take(self):
+        events, self.pending = self.pending, []
+        return events
+
+    def _work(self):
+        failed = False
+        while True:
+            with self.lock:
+                # after a failure, wait out the interval however many events pile up
+                self.cond.wait_for(
+                    lambda: self.closed
+                    or (not failed and len(self.pending) >= self.flush_every),
+                    timeout=self.flush_interval,
+                )
+                closed = self.closed
+                events = self._take()
+            if events:
+                try:
+                    if self.publish(events) is False:
+                        raise Exception("Publishing returned False")
+                    failed = False
+                    logger.debug(f"Published {len(events)} events")
+                except Exception as e:
+                    logger.warning(
+                        f"Failed to publish {len(events)} events", exc_info=e
+                    )
+                    failed = True
+                    with self.lock:
+                        self.pending[:0] = events
+            if closed:
+                return
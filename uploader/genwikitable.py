@@ -8,33 +8,13 @@ import functools
 
 import mwclient
 
+from normalize import fix_bookname_in_pagename
+
 CONFIG_FILE_PATH = os.path.join(os.path.dirname(__file__), "config.yml")
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 NAME_CAP_FIX_PATH = os.path.join(DATA_DIR, "namecapfix.yml")
 
 
-def fix_bookname_in_pagename(
-    bookname, apply_tortoise_shell_brackets_to_starting_of_title=False
-):
-    # if bookname.startswith("[") and bookname.endswith("]"):  # [四家四六]
-    #     bookname = bookname[1:-1]
-
-    if apply_tortoise_shell_brackets_to_starting_of_title and bookname.startswith("["):
-        bookname = re.sub(r"\[(.+?)\]", r"〔\1〕", bookname)  # [宋]...
-    bookname = re.sub(r"\[(.+?)\]", r"\1", bookname)
-    bookname = bookname.replace(":", "：")  # e.g. 404 00J001624 綠洲:中英文藝綜合月刊
-    bookname = bookname.replace("###", " ").replace("@@@", " ")
-    bookname = re.sub(r"\s+", " ", bookname)
-    bookname = bookname.replace("?", "□").replace(
-        "○", "〇"
-    )  # WHITE SQUARE, U+25A1, for, e.g. 892 312001039388 筠清?金石文字   五卷"
-    bookname = bookname.replace(
-        r"(?<=\d)\*(?=\d)", "×"
-    )  # e.g. 511 006031402010229 新湖北（14.7*21.6）1
-    bookname = re.sub(r'"([^"]+)"', r"“\1”", bookname)  # e.g. NLC-511-09000049
-    return bookname
-
-
 # TODO: implement secondary_volume support
 
 
@@ -1,7 +1,14 @@
 import re
 import logging
+import shutil
 import functools
+import hashlib
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import NamedTuple
 from io import BytesIO
 from urllib.parse import quote as urlquote
 import textwrap
@@ -14,8 +21,18 @@ from PIL import Image, ImageFont, ImageDraw
 import requests
 from qrcode import QRCode
 
+from httppool import PooledSession
+from mirrors import MirrorSet
+from pdfwriter import JpegPdfWriter, UnsupportedImage
+
 URL_READER = "http://read.nlc.cn/OutOpenBook/OpenObjectBook?aid={aid}&bid={bid}"
 URL_FILE = "http://read.nlc.cn/menhu/OutOpenBook/getReader?aid={aid}&bid={bid}&kime={kime}&fime={fime}"
+URL_DOC_FILE = "http://read.nlc.cn/{server}/{file_path}"
+
+DOC_SERVERS = ("doc1", "doc2", "doc3")
+# "token": open the reader for a token and request the file with it, as the web reader does
+# "direct": get the file from the doc servers by its path, falling back to "token"
+DOWNLOAD_STRATEGIES = ("token", "direct")
 
 REGEX_BOOK_ID = re.compile(r"var id = parseInt\(\'([\d.]+)\'\)")
 REGEX_COLLECTION_NAME = re.compile(r"var indexName\s*=\s*\'(\w+)\'")
@@ -26,26 +43,103 @@ REGEX_PRESS = re.compile(r"var pressName\s*=\s*\'(.*?)\'")
 REGEX_TOKEN_KEY = re.compile(r"tokenKey=\"(\w+)\"")
 REGEX_TIME_KEY = re.compile(r"timeKey=\"(\w+)\"")
 REGEX_TIME_FLAG = re.compile(r"timeFlag=\"(\w+)\"")
+REGEX_CONTENT_RANGE = re.compile(r"bytes (?:(\d+)-\d+|\*)/(\d+|\*)")
 
 USER_AGENT = "nlcpdbot/0.0 (+https://github.com/gowee/nlcpd)"
 
 FONT_FILE_PATH = Path(__file__).parent / "Aileron-Regular.otf"
 
+STREAM_CHUNK_SIZE = 1024 * 1024
+# bytes buffered in a chunk are lost when a transfer breaks off, so keep chunks small
+RESUMABLE_CHUNK_SIZE = 64 * 1024
+
+IMAGE_FETCH_WORKERS = 8
+IMAGE_FETCH_MAX_BUFFERED = 64 * 1024 * 1024
+
 
 logger = logging.getLogger(__name__)
 
 
+class Download(NamedTuple):
+    """A file downloaded to a spool file"""
+
+    path: Path
+    size: int
+    sha1: str
+
+
+def _install(part_path, spool_path):
+    """Move a completed file into place as `spool_path`
+
+    The spool file is replaced rather than truncated, as it may be a hard link to a cached
+    blob.
+    """
+    Path(part_path).replace(spool_path)
+
+
+def write_spool(path, chunks):
+    """Write chunks of bytes to `path`, hashing them on the fly"""
+    sha1 = hashlib.sha1()
+    size = 0
+    part_path = Path(str(path) + ".part")
+    with open(part_path, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+            sha1.update(chunk)
+            size += len(chunk)
+    _install(part_path, path)
+    return Download(Path(path), size, sha1.hexdigest())
+
+
+class RateLimiter:
+    """Space out requests by at least `min_interval` seconds, across all threads"""
+
+    def __init__(self, min_interval=0.0):
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def __call__(self):
+        if self.min_interval <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.min_interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+# shared by all workers of a process, configured via `nlc_min_interval`
+nlc_rate_limiter = RateLimiter()
+# shared likewise, configured via `doc_server_hedge_after`
+doc_mirrors = MirrorSet(DOC_SERVERS)
+# shared likewise, configured via `nlc_timeout`, `nlc_pool_size(s)` and `nlc_proxies`
+nlc_session = PooledSession()
+
+
+class Segmenting:
+    """Split downloads of at least `threshold` bytes into `segments` concurrent Range requests"""
+
+    def __init__(self, threshold=None, segments=4, tries=5):
+        self.threshold = threshold
+        self.segments = segments
+        self.tries = tries  # per segment
+
+
+# configured via `segmented_download_threshold` and `segmented_download_segments`
+segmenting = Segmenting()
+
+
 def retry(times=3):
     def wrapper(fn):
-        tried = 0
-
         @functools.wraps(fn)
         def wrapped(*args, **kwargs):
+            tried = 0  # per call, as calls may run concurrently in workers
             while True:
                 try:
                     return fn(*args, **kwargs)
                 except Exception as e:
-                    nonlocal tried
                     tried += 1
                     if tried >= times:
                         raise Exception(f"Failed finally after {times} tries") from e
@@ -58,9 +152,8 @@ def retry(times=3):
 
 @retry(7)
 def fetch_file(url, session=None):
-    resp = (session and session.get or requests.get)(
-        url, headers={"User-Agent": USER_AGENT}
-    )
+    nlc_rate_limiter()
+    resp = (session or nlc_session).get(url, headers={"User-Agent": USER_AGENT})
     resp.raise_for_status()
     assert len(resp.content) != 0, "Got empty file"
     if "Content-Length" in resp.headers:
@@ -73,17 +166,76 @@ def fetch_file(url, session=None):
     return resp.content
 
 
-def construct_failure_page(url, page_name=""):
-    qr = QRCode(box_size=3)
+FAILURE_PAGE_FONT_SIZE = 20
+FAILURE_PAGE_MARGIN = (5, 5)
+FAILURE_PAGE_SPACING = 3
+FAILURE_PAGE_QR_BOX_SIZE = 3
+# picking the best of the 8 mask patterns takes most of the time to make a QR code, while any
+# of them scans
+FAILURE_PAGE_QR_MASK_PATTERN = 0
+
+
+@functools.lru_cache(maxsize=None)
+def failure_page_font():
+    return ImageFont.truetype(str(FONT_FILE_PATH), size=FAILURE_PAGE_FONT_SIZE)
+
+
+@functools.lru_cache(maxsize=None)
+def failure_page_glyph(char):
+    """Mask of a character, its offset and advance, from which lines are composed"""
+    font = failure_page_font()
+    ascent, descent = font.getmetrics()
+    left, _, right, _ = font.getbbox(char)
+    glyph = Image.new("L", (max(right - left, 0), ascent + descent))
+    ImageDraw.Draw(glyph).text((-left, 0), char, font=font, fill=255)
+    return glyph, left, font.getlength(char)
+
+
+def failure_page_text_mask(text):
+    """Mask of a line, composed of cached glyphs as rasterizing is slow"""
+    ascent, descent = failure_page_font().getmetrics()
+    glyphs = [failure_page_glyph(char) for char in text]
+    width = max(
+        (round(x) + left + glyph.size[0] for x, (glyph, left, _) in _advances(glyphs)),
+        default=0,
+    )
+    mask = Image.new("L", (width, ascent + descent))
+    for x, (glyph, left, _) in _advances(glyphs):
+        mask.paste(255, (round(x) + left, 0), glyph)
+    return mask
+
+
+def _advances(glyphs):
+    x = 0.0
+    for glyph in glyphs:
+        yield x, glyph
+        x += glyph[2]
+
+
+def failure_page_qr(url):
+    qr = QRCode(
+        box_size=FAILURE_PAGE_QR_BOX_SIZE, mask_pattern=FAILURE_PAGE_QR_MASK_PATTERN
+    )
     qr.add_data(url)
     qr.make()
-    qr_img = qr.make_image()
+    # drawn from the module matrix directly rather than box by box by qrcode
+    matrix = qr.get_matrix()
+    modules = Image.frombytes(
+        "L",
+        (len(matrix), len(matrix)),
+        bytes(0 if dark else 255 for row in matrix for dark in row),
+    )
+    return modules.resize(
+        (len(matrix) * qr.box_size, len(matrix) * qr.box_size), Image.NEAREST
+    )
+
 
+def construct_failure_page(url, page_name=""):
     # ref: https://stackoverflow.com/a/1970930/5488616
     #      https://stackoverflow.com/a/68648910/5488616
     #      ChatGPT
 
-    font = ImageFont.truetype(str(FONT_FILE_PATH), size=20)
+    qr_img = failure_page_qr(url)
 
     t = datetime.datetime.now(timezone.utc)
     assert t.tzinfo == timezone.utc
@@ -95,9 +247,9 @@ def construct_failure_page(url, page_name=""):
         "Access time: " + str(t),
     ]
 
-    margin = (5, 5)
-    spacing = 3
-    mask_images = [font.getmask(text, "L") for text in texts]
+    margin = FAILURE_PAGE_MARGIN
+    spacing = FAILURE_PAGE_SPACING
+    mask_images = [failure_page_text_mask(text) for text in texts]
     width = (
         max(max(mask_image.size[0] for mask_image in mask_images), qr_img.size[0])
         + margin[0] * 2
@@ -109,16 +261,10 @@ def construct_failure_page(url, page_name=""):
         + spacing
         + qr_img.size[1]
     )
-    # mask_image = font.getmask(text, "L")
     img = Image.new("RGB", (width, height), (255, 255, 255))
     y = margin[1]
     for mask_image in mask_images:
-        # need to use the inner `img.im.paste` due to `getmask` returning a core
-        img.im.paste(
-            (0, 0, 0),
-            (margin[0], y, margin[0] + mask_image.size[0], y + mask_image.size[1]),
-            mask_image,
-        )
+        img.paste((0, 0, 0), (margin[0], y), mask_image)
         y += mask_image.size[1] + spacing
     img.paste(qr_img, (0, y))
 
@@ -127,23 +273,120 @@ def construct_failure_page(url, page_name=""):
     return output.getvalue()
 
 
-@retry(3)
-def fetch_image_list(image_urls, file=None):
-    session = requests.Session()  # <del>activate connection reuse</del>
-    images = []
-    failures = 0
-    for i, url in enumerate(image_urls):
+def page_spool_dir(spool_path):
+    """The directory keeping the downloaded pages of an image-list volume"""
+    return Path(str(spool_path) + ".pages")
+
+
+def remove_page_spool(spool_path):
+    shutil.rmtree(page_spool_dir(spool_path), ignore_errors=True)
+
+
+def fetch_pages(
+    image_urls, session, workers, max_buffered, page_dir=None, placeholders=None
+):
+    """Yield `(image, failed)` for pages in order, downloading several of them concurrently
+
+    Pages downloaded ahead of the one yielded next take up to about `max_buffered` bytes.
+    Pages failing to download are replaced with placeholders. With `page_dir`, downloaded
+    pages are saved there by the hash of their urls, and only missing ones are downloaded.
+    With `placeholders`, placeholders are kept there by url, and those pages are not
+    downloaded again, unlike those left out of `page_dir`.
+    """
+
+    def fetch(i, url):
+        if placeholders is not None and url in placeholders:
+            return placeholders[url], True
+        if page_dir is not None:
+            page_path = page_dir / (
+                hashlib.sha1(url.encode("utf-8")).hexdigest() + ".jpg"
+            )
+            if page_path.exists():
+                return page_path.read_bytes(), False
         logger.debug(f"Downloading {url}")
-        assert url.endswith(".jpg"), "Expected JPG: " + url
         try:
             image = fetch_file(url, session)
+            if page_dir is not None:
+                # never leave a partial page behind to be taken as complete
+                temp_path = page_path.with_suffix(".tmp")
+                temp_path.write_bytes(image)
+                temp_path.rename(page_path)
+            return image, False
         except Exception as e:
             logger.warning(
                 f"Failed to download {url}, using placeholder image", exc_info=e
             )
-            image = construct_failure_page(url, page_name=f"({i+1}/{len(image_urls)})")
-            failures += 1
+            page_name = f"({i+1}/{len(image_urls)})"
+            placeholder = construct_failure_page(url, page_name=page_name)
+            if placeholders is not None:
+                placeholders[url] = placeholder
+            return placeholder, True
+
+    def buffered(pending):
+        return sum(len(f.result()[0]) for f in pending if f.done())
+
+    with ThreadPoolExecutor(workers, thread_name_prefix="page") as executor:
+        pending = deque()
+        for i, url in enumerate(image_urls):
+            assert url.endswith(".jpg"), "Expected JPG: " + url
+            # a slow page holds up yielding, so allow some more to be downloaded behind it
+            while pending and (
+                len(pending) >= workers * 4 or buffered(pending) >= max_buffered
+            ):
+                yield pending.popleft().result()
+            pending.append(executor.submit(fetch, i, url))
+        while pending:
+            yield pending.popleft().result()
+
+
+@retry(3)
+def fetch_image_list(
+    image_urls,
+    spool_path,
+    workers=IMAGE_FETCH_WORKERS,
+    max_buffered=IMAGE_FETCH_MAX_BUFFERED,
+):
+    # kept across retries and runs until the volume is uploaded
+    page_dir = page_spool_dir(spool_path)
+    page_dir.mkdir(exist_ok=True)
+    # pages failed are tried again on the next retry, but not by the fallback below
+    placeholders = {}
+    pages = functools.partial(
+        fetch_pages,
+        image_urls,
+        nlc_session,
+        workers,
+        max_buffered,
+        page_dir,
+        placeholders,
+    )
+    part_path = Path(str(spool_path) + ".part")
+    failures = 0
+    try:
+        # page by page from the downloads, with memory use independent of the page count
+        with JpegPdfWriter(part_path) as pdf:
+            for image, failed in pages():
+                pdf.add_jpeg(image)
+                failures += failed
+            assert failures < len(image_urls), "Failed to download all images"
+            size, sha1 = pdf.close()
+    except UnsupportedImage as e:
+        logger.info(f"Falling back to img2pdf: {e}")
+        part_path.unlink(missing_ok=True)
+    else:
+        logger.info(
+            f"PDF constructed ({len(image_urls)} images, {failures} failures => {size} B)"
+        )
+        _install(part_path, spool_path)
+        return Download(Path(spool_path), size, sha1)
+
+    # the pages downloaded so far are taken from the page spool this time, and the pages
+    # failed from the placeholders
+    images = []
+    failures = 0
+    for image, failed in pages():
         images.append(image)
+        failures += failed
     assert failures < len(image_urls), "Failed to download all images"
     blob = img2pdf.convert(images)
     # with cached_path.open("wb") as f:
@@ -151,76 +394,321 @@ def fetch_image_list(image_urls, file=None):
     logger.info(
         f"PDF constructed ({len(image_urls)} images, {failures} failures, {sum(map(len, images))} => {len(blob)} B)"
     )
-    # with save_path.open("wb") as f:
-    if file:
-        file.write(blob)
-    else:
-        return blob
+    return write_spool(spool_path, [blob])
 
 
-def getbook(aid: str, bid: str, file_path=None, proxies=None):
-    if file_path and not isinstance(file_path, str):
-        return fetch_image_list(file_path)
-    else:
-        resp = requests.get(
-            URL_READER.format(aid=aid, bid=bid),
-            headers={"User-Agent": USER_AGENT},
-            proxies=proxies,
-        )
+class IncompleteDownload(IOError):
+    pass
+
+
+def sha1_of_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        while chunk := f.read(STREAM_CHUNK_SIZE):
+            sha1.update(chunk)
+    return sha1
+
+
+def parse_content_range(content_range):
+    """Parse "bytes start-end/total" into (start, total), with total being None if unknown"""
+    match = REGEX_CONTENT_RANGE.match(content_range or "")
+    if not match:
+        raise ValueError(f"Invalid Content-Range: {content_range}")
+    start, total = match.groups()
+    return start and int(start), None if total == "*" else int(total)
+
+
+def stream_pdf(open_response, spool_path, max_resumes=5) -> Download:
+    """Stream a PDF into `spool_path`, resuming with Range requests if the transfer breaks off
+
+    `open_response(headers)` is to send the request with the extra `headers`, returning a
+    response with `stream=True`. Received bytes are kept in a `.part` file next to the spool
+    file until complete, so that a later call for the same spool file resumes too. The
+    `ETag` or `Last-Modified` of the file is kept along in a `.part.validator` file, without
+    which a `.part` file left by an earlier call is discarded, as the file may have changed.
+    """
+    part_path = Path(str(spool_path) + ".part")
+    validator_path = Path(str(spool_path) + ".part.validator")
+    validator = None
+    if part_path.exists():
+        if validator_path.exists():
+            validator = validator_path.read_text()
+        else:
+            logger.info("Discarding a partial download of unknown version")
+            part_path.unlink()
+    if segmenting.threshold and not part_path.exists():
+        if download := fetch_segmented(open_response, spool_path):
+            return download
+    resumes = 0
+    # a partial download is kept along with its validator only if it is resumable
+    resumable = part_path.exists()
+    while True:
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        # sizes are to be compared with the bytes on the wire
+        headers = {"Accept-Encoding": "identity"}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            if validator:
+                # get the whole file instead if it has changed since
+                headers["If-Range"] = validator
+        try:
+            with open_response(headers) as resp:
+                if resp.status_code == 416 and offset:
+                    try:
+                        _, total = parse_content_range(
+                            resp.headers.get("Content-Range")
+                        )
+                    except ValueError:
+                        total = None
+                    if total == offset:
+                        # completed right before breaking off last time
+                        sha1 = sha1_of_file(part_path)
+                        break
+                    logger.info(f"Unsatisfiable range: {offset}/{total}, starting over")
+                    part_path.unlink()
+                    validator_path.unlink(missing_ok=True)
+                    validator = None
+                    continue
+                resp.raise_for_status()
+                assert resp.headers.get("Content-Type", "").endswith(
+                    "/pdf"
+                ) or resp.headers.get("Content-Type", "").endswith("/octet-stream")
+                resumable = resp.headers.get("Accept-Ranges") == "bytes"
+                if resp.status_code == 206:
+                    resumable = True
+                    start, total = parse_content_range(resp.headers["Content-Range"])
+                    assert start == offset, f"Range mismatch: {start} != {offset}"
+                    logger.info(f"Resuming download at {offset}/{total} B")
+                    sha1 = sha1_of_file(part_path)
+                    mode = "ab"
+                else:
+                    # the server may ignore Range and send the file from the start
+                    offset = 0
+                    total = (
+                        int(resp.headers["Content-Length"])
+                        if "Content-Length" in resp.headers
+                        else None
+                    )
+                    validator = resp.headers.get("ETag") or resp.headers.get(
+                        "Last-Modified"
+                    )
+                    if validator:
+                        validator_path.write_text(validator)
+                    else:
+                        validator_path.unlink(missing_ok=True)
+                    sha1 = hashlib.sha1()
+                    mode = "wb"
+                size = offset
+                with open(part_path, mode) as f:
+                    for chunk in resp.iter_content(chunk_size=RESUMABLE_CHUNK_SIZE):
+                        f.write(chunk)
+                        sha1.update(chunk)
+                        size += len(chunk)
+                if total is not None and size != total:
+                    # https://blog.petrzemek.net/2018/04/22/on-incomplete-http-reads-and-the-requests-library-in-python/
+                    raise IncompleteDownload(f"Incomplete download: {size}/{total}")
+            break
+        except (IncompleteDownload, requests.exceptions.RequestException) as e:
+            # including failing to send a resuming request at all
+            if not resumable or resumes >= max_resumes:
+                raise
+            resumes += 1
+            logger.info(
+                f"Download broke off, resuming ({resumes}/{max_resumes})", exc_info=e
+            )
+    size = part_path.stat().st_size
+    assert size != 0, "Got empty file"
+    validator_path.unlink(missing_ok=True)
+    _install(part_path, spool_path)
+    return Download(Path(spool_path), size, sha1.hexdigest())
+
+
+def fetch_segmented(open_response, spool_path):
+    """Download a file in segments concurrently, if it is large enough and Range is supported
+
+    Returns None without downloading anything otherwise. Each segment is written at its offset
+    in a preallocated file as it arrives, so memory use is independent of the file size.
+    """
+    resp = open_response({"Accept-Encoding": "identity", "Range": "bytes=0-0"})
+    with resp:
         resp.raise_for_status()
-        html = resp.text
-        # print(html)
-        # print(URL_READER.format(aid=aid, bid=bid))
-        (
-            book_id,
-            collection_id,  # aid prefixed with "data_"
-            book_title,
-            file_id,
-            file_path,
-            press,
-            token_key,  # part of key
-            time_key,  # part of key
-            time_flag,  # part of key
-        ) = map(
-            lambda p: False or p.search(html).group(1),
-            [
-                REGEX_BOOK_ID,
-                REGEX_COLLECTION_NAME,
-                REGEX_BOOK_TITLE,
-                REGEX_FILE_ID,
-                REGEX_FILE_PATH,
-                REGEX_PRESS,
-                REGEX_TOKEN_KEY,
-                REGEX_TIME_KEY,
-                REGEX_TIME_FLAG,
-            ],
+        if resp.status_code != 206:
+            logger.debug("Range not supported, downloading in a single stream")
+            return None
+        assert resp.headers.get("Content-Type", "").endswith(
+            "/pdf"
+        ) or resp.headers.get("Content-Type", "").endswith("/octet-stream")
+        _, total = parse_content_range(resp.headers["Content-Range"])
+    if total is None or total < segmenting.threshold:
+        return None
+
+    segment_size = -(-total // segmenting.segments)
+    ranges = [
+        (start, min(start + segment_size, total) - 1)
+        for start in range(0, total, segment_size)
+    ]
+    logger.info(f"Downloading {total} B in {len(ranges)} segments")
+    # not the .part file, which would look complete to a resuming download
+    segments_path = Path(str(spool_path) + ".segments")
+    with open(segments_path, "wb") as f:
+        f.truncate(total)
+
+    aborted = threading.Event()
+
+    def fetch_segment(start, end):
+        pos = start
+        tried = 0
+        while True:
+            try:
+                resp = open_response(
+                    {"Accept-Encoding": "identity", "Range": f"bytes={pos}-{end}"}
+                )
+                with resp, open(segments_path, "r+b") as f:
+                    resp.raise_for_status()
+                    if resp.status_code != 206:
+                        raise IncompleteDownload(f"Range {pos}-{end} ignored")
+                    got_start, _ = parse_content_range(resp.headers["Content-Range"])
+                    assert got_start == pos, f"Range mismatch: {got_start} != {pos}"
+                    f.seek(pos)
+                    for chunk in resp.iter_content(chunk_size=RESUMABLE_CHUNK_SIZE):
+                        if aborted.is_set():
+                            return  # another segment failed finally
+                        f.write(chunk[: end + 1 - pos])
+                        pos += len(chunk)
+                if pos < end + 1:
+                    raise IncompleteDownload(f"Incomplete segment: {pos}/{end + 1}")
+                return
+            except (IncompleteDownload, requests.exceptions.RequestException) as e:
+                tried += 1
+                if tried >= segmenting.tries:
+                    raise
+                logger.info(
+                    f"Segment {start}-{end} broke off at {pos}, retrying ({tried}/{segmenting.tries})",
+                    exc_info=e,
+                )
+
+    executor = ThreadPoolExecutor(len(ranges), thread_name_prefix="segment")
+    try:
+        for future in [executor.submit(fetch_segment, *r) for r in ranges]:
+            future.result()
+    except BaseException:
+        aborted.set()
+        executor.shutdown(wait=True)
+        segments_path.unlink(missing_ok=True)
+        raise
+    executor.shutdown()
+    sha1 = sha1_of_file(segments_path)
+    _install(segments_path, spool_path)
+    return Download(Path(spool_path), total, sha1.hexdigest())
+
+
+def fetch_direct(file_path, spool_path, proxies=None) -> Download:
+    """Download a file by its path from the best doc server having it"""
+
+    def open_url(url, headers):
+        logger.debug(f"Downloading {url}")
+        nlc_rate_limiter()
+        return nlc_session.get(
+            url,
+            headers={"User-Agent": USER_AGENT} | headers,
+            proxies=proxies,
+            stream=True,
         )
 
-        # Volume(
-        #     id=file_id,
-        #     file_path=file_path,
-        #     book_id=book_id,
-        #     book_title=book_title,
-        #     press_name=press,
-        #     collection_id=collection_id,
-        # ),
-        # (token_key, time_key, time_flag),
-        # print(time_key, time_flag, token_key)
-        resp = requests.post(
+    def url_for(server):
+        return URL_DOC_FILE.format(server=server, file_path=file_path.lstrip("/"))
+
+    server = None
+
+    def open_response(headers):
+        nonlocal server
+        if file_path.startswith("http"):
+            return open_url(file_path, headers)
+        if server is None:
+            server, resp = doc_mirrors.open(lambda s: open_url(url_for(s), headers))
+            return resp
+        # resume from where the chosen server broke off
+        return open_url(url_for(server), headers)
+
+    try:
+        download = stream_pdf(open_response, spool_path)
+        with open(download.path, "rb") as f:
+            # error pages may be served as 200 too
+            assert f.read(5) == b"%PDF-", f"Not a PDF: {file_path}"
+    except Exception:
+        if server is not None:
+            doc_mirrors.record(server, error=True)
+        raise
+    return download
+
+
+def getbook(
+    aid: str, bid: str, spool_path, file_path=None, proxies=None, strategy="token"
+) -> Download:
+    """Download a volume into `spool_path`"""
+    if file_path and not isinstance(file_path, str):
+        return fetch_image_list(file_path, spool_path)
+    if strategy == "direct" and file_path:
+        try:
+            return fetch_direct(file_path, spool_path, proxies)
+        except Exception as e:
+            logger.info(
+                f"Failed to get {file_path} directly, falling back to the reader",
+                exc_info=e,
+            )
+    nlc_rate_limiter()
+    resp = nlc_session.get(
+        URL_READER.format(aid=aid, bid=bid),
+        headers={"User-Agent": USER_AGENT},
+        proxies=proxies,
+    )
+    resp.raise_for_status()
+    html = resp.text
+    # print(html)
+    # print(URL_READER.format(aid=aid, bid=bid))
+    (
+        book_id,
+        collection_id,  # aid prefixed with "data_"
+        book_title,
+        file_id,
+        file_path,
+        press,
+        token_key,  # part of key
+        time_key,  # part of key
+        time_flag,  # part of key
+    ) = map(
+        lambda p: False or p.search(html).group(1),
+        [
+            REGEX_BOOK_ID,
+            REGEX_COLLECTION_NAME,
+            REGEX_BOOK_TITLE,
+            REGEX_FILE_ID,
+            REGEX_FILE_PATH,
+            REGEX_PRESS,
+            REGEX_TOKEN_KEY,
+            REGEX_TIME_KEY,
+            REGEX_TIME_FLAG,
+        ],
+    )
+
+    # Volume(
+    #     id=file_id,
+    #     file_path=file_path,
+    #     book_id=book_id,
+    #     book_title=book_title,
+    #     press_name=press,
+    #     collection_id=collection_id,
+    # ),
+    # (token_key, time_key, time_flag),
+    # print(time_key, time_flag, token_key)
+
+    def open_response(headers):
+        nlc_rate_limiter()
+        return nlc_session.post(
             URL_FILE.format(aid=aid, bid=bid, kime=time_key, fime=time_flag),
-            headers={"User-Agent": USER_AGENT, "myreader": token_key},
+            headers={"User-Agent": USER_AGENT, "myreader": token_key} | headers,
             proxies=proxies,
+            stream=True,
         )
-        resp.raise_for_status()
-        assert resp.headers.get("Content-Type").endswith("/pdf") or resp.headers.get(
-            "Content-Type"
-        ).endswith("/octet-stream")
-        assert len(resp.content) != 0, "Got empty file"
-        if "Content-Length" in resp.headers:
-            # https://blog.petrzemek.net/2018/04/22/on-incomplete-http-reads-and-the-requests-library-in-python/
-            expected_size = int(resp.headers["Content-Length"])
-            actual_size = resp.raw.tell()
-            assert (
-                expected_size == actual_size
-            ), f"Incomplete download: {actual_size}/{expected_size}"
-        return resp.content
+
+    return stream_pdf(open_response, spool_path)
@@ -0,0 +1,83 @@
+"""A pool of keep-alive connections shared by all threads, with timeouts"""
+
+import logging
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = (10, 60)  # seconds to connect, and between bytes read
+DEFAULT_POOL_SIZE = 16
+# hosts whose pools are kept, which is also how many hosts the stats cover
+MAX_POOLS = 64
+
+
+class PooledSession(requests.Session):
+    """A session reusing connections across requests and threads
+
+    Requests without a `timeout` get `timeout` as `(connect, read)` seconds, so that a stalled
+    socket fails instead of hanging. Requests without `proxies` go through the session's
+    `proxies`, ahead of any from the environment. Cookies are never kept, so that no state but
+    connections is shared across threads.
+
+    Up to `pool_size` idle connections are kept per host, or the size given by `pool_sizes`,
+    which maps hosts to sizes.
+    """
+
+    def __init__(
+        self,
+        timeout=DEFAULT_TIMEOUT,
+        pool_size=DEFAULT_POOL_SIZE,
+        pool_sizes=None,
+        proxies=None,
+    ):
+        super().__init__()
+        self.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self.configure(timeout, pool_size, pool_sizes, proxies)
+
+    def configure(
+        self,
+        timeout=DEFAULT_TIMEOUT,
+        pool_size=DEFAULT_POOL_SIZE,
+        pool_sizes=None,
+        proxies=None,
+    ):
+        """(Re)configure the session, before it is used"""
+        self.timeout = tuple(timeout) if isinstance(timeout, list) else timeout
+        self.proxies = proxies or {}
+        self.adapters.clear()
+        for scheme in ("https://", "http://"):
+            self.mount(scheme, _adapter(pool_size))
+            for host, size in (pool_sizes or {}).items():
+                self.mount(f"{scheme}{host}/", _adapter(size))
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        if kwargs.get("proxies") is None:
+            kwargs["proxies"] = self.proxies
+        return super().request(method, url, **kwargs)
+
+    def stats(self):
+        """Requests made and connections opened per host, with the connections reused"""
+        stats = {}
+        for adapter in set(self.adapters.values()):
+            for manager in [adapter.poolmanager, *adapter.proxy_manager.values()]:
+                for key in manager.pools.keys():
+                    try:
+                        pool = manager.pools[key]
+                    except KeyError:  # evicted meanwhile
+                        continue
+                    host = stats.setdefault(
+                        pool.host, {"requests": 0, "connections": 0, "reused": 0}
+                    )
+                    host["requests"] += pool.num_requests
+                    host["connections"] += pool.num_connections
+                    host["reused"] += pool.num_requests - pool.num_connections
+        return stats
+
+
+def _adapter(pool_size):
+    return HTTPAdapter(pool_connections=MAX_POOLS, pool_maxsize=pool_size)
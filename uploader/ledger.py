@@ -0,0 +1,227 @@
+"""A local per-volume job ledger of a batch, backed by SQLite"""
+
+import os
+import socket
+import sqlite3
+import threading
+from datetime import datetime, timezone, timedelta
+
+PENDING = "pending"
+DOWNLOADED = "downloaded"
+UPLOADED = "uploaded"
+FAILED = "failed"
+DUPLICATE = "duplicate"
+
+FINISHED = (UPLOADED, DUPLICATE)
+IN_PROGRESS = (PENDING, DOWNLOADED)
+
+# claims by workers that have not finished in time are considered abandoned, as are claims by
+# processes no longer running on this host
+CLAIM_TIMEOUT = timedelta(hours=6)
+
+SCHEMA = """\
+CREATE TABLE IF NOT EXISTS volumes (
+    dbid TEXT NOT NULL,
+    bookid TEXT NOT NULL,
+    volumeid TEXT NOT NULL,
+    pagename TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    size INTEGER,
+    error TEXT,
+    sha1 TEXT,
+    claimed_by TEXT,
+    claimed_at TEXT,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (dbid, bookid, volumeid)
+)
+"""
+
+# columns added after the initial schema, for ledgers created by older versions
+MIGRATIONS = {
+    "claimed_by": "TEXT",
+    "claimed_at": "TEXT",
+    "sha1": "TEXT",
+}
+
+
+def volume_key(dbid, bookid, volumeid):
+    return str(dbid).strip(), str(bookid).strip(), str(volumeid).strip()
+
+
+def process_id():
+    """Identify this process by host and pid, as the prefix of the ids of its workers"""
+    return f"{socket.gethostname()}:{os.getpid()}:"
+
+
+def worker_id():
+    """Identify the current thread as a worker claiming volumes"""
+    return process_id() + threading.current_thread().name
+
+
+def is_abandoned(worker):
+    """Check if the process of a worker is known to be gone, i.e. it is on this host but no
+    longer running"""
+    host, pid, _thread = worker.split(":", 2)
+    if host != socket.gethostname() or int(pid) == os.getpid():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:  # running as another user
+        return False
+    return False
+
+
+class Ledger:
+    """Tracks the state of every volume of a batch, keyed by (dbid, bookid, volumeid)
+
+    States go pending -> downloaded -> uploaded | duplicate, or failed at any point. A worker
+    claims a volume before working on it, so that several workers, in threads or processes,
+    may share a ledger. Claims are released by `release` once a process is done, or taken over
+    once abandoned. The connection is shared between threads, so all statements are
+    serialized with a lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            path, timeout=60, check_same_thread=False, isolation_level=None
+        )
+        self.conn.create_function("abandoned", 1, is_abandoned)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(SCHEMA)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(volumes)")}
+        for column, type_ in MIGRATIONS.items():
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE volumes ADD COLUMN {column} {type_}")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS volumes_sha1 ON volumes (sha1)")
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM volumes").fetchone()[0]
+
+    def keys(self, states):
+        """Get the keys of all volumes in any of the `states`"""
+        with self.lock:
+            return {
+                tuple(row)
+                for row in self.conn.execute(
+                    f"SELECT dbid, bookid, volumeid FROM volumes WHERE state IN ({', '.join('?' * len(states))})",
+                    states,
+                )
+            }
+
+    def summary(self):
+        with self.lock:
+            return dict(
+                self.conn.execute(
+                    "SELECT state, COUNT(*) FROM volumes GROUP BY state ORDER BY state"
+                )
+            )
+
+    def claim(self, key, worker, refresh=False):
+        """Atomically claim a volume for `worker`, returning False if it is claimed by another
+        or, unless `refresh`, if it has been finished meanwhile, e.g. by another process
+        """
+        now = datetime.now(timezone.utc)
+        with self.lock:
+            return (
+                self.conn.execute(
+                    f"""INSERT INTO volumes (dbid, bookid, volumeid, claimed_by, claimed_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (dbid, bookid, volumeid) DO UPDATE SET
+                        claimed_by = excluded.claimed_by,
+                        claimed_at = excluded.claimed_at
+                    WHERE (claimed_by IS NULL OR claimed_by = excluded.claimed_by OR claimed_at < ?
+                        OR abandoned(claimed_by))
+                        AND (? OR state NOT IN ({', '.join('?' * len(FINISHED))}))""",
+                    (
+                        *key,
+                        worker,
+                        _isoformat(now),
+                        _isoformat(now),
+                        _isoformat(now - CLAIM_TIMEOUT),
+                        refresh,
+                        *FINISHED,
+                    ),
+                ).rowcount
+                == 1
+            )
+
+    def release(self, process=None):
+        """Release all claims by the workers of `process`, by default this one, whatever state
+        the volumes are left in"""
+        process = process or process_id()
+        with self.lock:
+            return self.conn.execute(
+                """UPDATE volumes SET claimed_by = NULL, claimed_at = NULL
+                WHERE substr(claimed_by, 1, ?) = ?""",
+                (len(process), process),
+            ).rowcount
+
+    def start(self, key, pagename=None):
+        """Record a new attempt on a volume"""
+        with self.lock:
+            self.conn.execute(
+                """INSERT INTO volumes (dbid, bookid, volumeid, pagename, state, attempts, updated_at)
+                VALUES (?, ?, ?, ?, ?, 1, ?)
+                ON CONFLICT (dbid, bookid, volumeid) DO UPDATE SET
+                    pagename = COALESCE(excluded.pagename, pagename),
+                    state = excluded.state,
+                    attempts = attempts + 1,
+                    error = NULL,
+                    updated_at = excluded.updated_at""",
+                (*key, pagename, PENDING, _now()),
+            )
+
+    def find_uploaded(self, sha1, exclude=None):
+        """Find the page name of an uploaded volume by the SHA-1 of its file"""
+        with self.lock:
+            row = self.conn.execute(
+                """SELECT pagename FROM volumes
+                WHERE sha1 = ? AND state = ? AND pagename IS NOT NULL
+                    AND (dbid, bookid, volumeid) IS NOT (?, ?, ?)
+                LIMIT 1""",
+                (sha1, UPLOADED, *(exclude or (None, None, None))),
+            ).fetchone()
+        return row and row[0]
+
+    def mark(self, key, state, pagename=None, size=None, error=None, sha1=None):
+        """Update the state of a volume, which also releases the claim on it unless it is still
+        being worked on"""
+        with self.lock:
+            self.conn.execute(
+                """INSERT INTO volumes (dbid, bookid, volumeid, pagename, state, size, sha1, error, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (dbid, bookid, volumeid) DO UPDATE SET
+                    pagename = COALESCE(excluded.pagename, pagename),
+                    state = excluded.state,
+                    size = COALESCE(excluded.size, size),
+                    sha1 = COALESCE(excluded.sha1, sha1),
+                    error = excluded.error,
+                    claimed_by = CASE WHEN excluded.state IN (?, ?) THEN claimed_by END,
+                    claimed_at = CASE WHEN excluded.state IN (?, ?) THEN claimed_at END,
+                    updated_at = excluded.updated_at""",
+                (
+                    *key,
+                    pagename,
+                    state,
+                    size,
+                    sha1,
+                    error,
+                    _now(),
+                    *IN_PROGRESS,
+                    *IN_PROGRESS,
+                ),
+            )
+
+
+def _now():
+    return _isoformat(datetime.now(timezone.utc))
+
+
+def _isoformat(t):
+    return t.isoformat(timespec="seconds")
@@ -0,0 +1,149 @@
+"""Pick among mirrors serving the same files by their observed latency and errors"""
+
+import logging
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+
+class MirrorStats:
+    def __init__(self):
+        self.latency = None  # EWMA of seconds to the response headers
+        self.error_rate = 0.0  # EWMA of 1 for errors and 0 for successes
+        self.requests = 0
+        self.errors = 0
+        self.hedges = 0  # times a hedge was sent because this mirror was slow
+
+
+class MirrorSet:
+    """Rolling latency and error statistics of a set of mirrors
+
+    `open` tries mirrors from the fastest healthy one on. With `hedge_after` seconds set, a
+    request still without a response by then is raced against one to the next mirror, and
+    whichever responds first wins.
+    """
+
+    def __init__(self, mirrors, alpha=0.2, hedge_after=None, max_error_rate=0.5):
+        self.alpha = alpha
+        self.hedge_after = hedge_after
+        self.max_error_rate = max_error_rate
+        self.stats = {mirror: MirrorStats() for mirror in mirrors}
+        self.lock = threading.Lock()
+
+    def ranked(self):
+        """Healthy mirrors by latency weighed by error rate, then unhealthy ones by error rate
+
+        Mirrors yet to be sampled go first, as if they were the fastest."""
+
+        def rank(mirror):
+            stats = self.stats[mirror]
+            if stats.error_rate >= self.max_error_rate:
+                return 1, stats.error_rate
+            if stats.latency is None:
+                return 0, 0.0 if stats.requests == 0 else math.inf
+            return 0, stats.latency / (1 - stats.error_rate)
+
+        with self.lock:
+            return sorted(self.stats, key=rank)
+
+    def record(self, mirror, latency=None, error=False):
+        with self.lock:
+            stats = self.stats[mirror]
+            stats.requests += 1
+            stats.errors += error
+            stats.error_rate += self.alpha * (error - stats.error_rate)
+            if latency is not None:
+                if stats.latency is None:
+                    stats.latency = latency
+                else:
+                    stats.latency += self.alpha * (latency - stats.latency)
+
+    def metrics(self):
+        with self.lock:
+            return {mirror: vars(stats).copy() for mirror, stats in self.stats.items()}
+
+    def open(self, open_mirror):
+        """Return `(mirror, response)` for the first successful `open_mirror(mirror)`
+
+        `open_mirror` is expected to return a streamed `requests` response. 404 is taken as the
+        file being absent from that mirror rather than as an error. FileNotFoundError is raised
+        if no mirror has the file.
+        """
+        candidates = deque(self.ranked())
+        futures = {}
+        last_error = None
+        executor = ThreadPoolExecutor(len(candidates), thread_name_prefix="mirror")
+
+        def launch():
+            mirror = candidates.popleft()
+            futures[executor.submit(self._attempt, mirror, open_mirror)] = mirror
+
+        try:
+            launch()
+            while futures:
+                hedging = (
+                    self.hedge_after is not None and candidates and len(futures) == 1
+                )
+                done, _ = wait(
+                    futures,
+                    timeout=self.hedge_after if hedging else None,
+                    return_when=FIRST_COMPLETED,
+                )
+                if not done:
+                    (slow,) = futures.values()
+                    logger.debug(f"{slow} is slow, hedging with {candidates[0]}")
+                    with self.lock:
+                        stats = self.stats[slow]
+                        stats.hedges += 1
+                        # rank it down now rather than only once it responds, if ever
+                        if stats.latency is None or stats.latency < self.hedge_after:
+                            stats.latency = self.hedge_after
+                    launch()
+                    continue
+                for future in done:
+                    mirror = futures.pop(future)
+                    try:
+                        resp = future.result()
+                    except Exception as e:
+                        last_error = e
+                        continue
+                    if resp is not None:
+                        for loser in futures:
+                            loser.add_done_callback(_close_response)
+                        return mirror, resp
+                if not futures and candidates:
+                    launch()
+        finally:
+            # never wait for a losing request, which may hang for long
+            executor.shutdown(wait=False)
+        if last_error is not None:
+            raise last_error
+        raise FileNotFoundError("Not found on any mirror")
+
+    def _attempt(self, mirror, open_mirror):
+        start = time.monotonic()
+        try:
+            resp = open_mirror(mirror)
+        except Exception:
+            self.record(mirror, error=True)
+            raise
+        latency = time.monotonic() - start
+        if resp.status_code == 404:
+            self.record(mirror, latency)
+            resp.close()
+            return None
+        if not resp.ok:
+            self.record(mirror, error=True)
+            resp.close()
+            resp.raise_for_status()
+        self.record(mirror, latency)
+        return resp
+
+
+def _close_response(future):
+    if future.exception() is None and future.result() is not None:
+        future.result().close()
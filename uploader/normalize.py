@@ -0,0 +1,104 @@
+"""Normalization of book names and bylines, shared by the uploader and the table scripts
+
+Filenames on Commons are derived from these, so any change here renames files of later
+uploads. Check the parity with `bench_normalize.py` before changing anything.
+"""
+
+import re
+from functools import lru_cache
+
+# normalizing is pure, and a name is normalized for every volume of its book
+CACHE_SIZE = 1 << 16
+
+REGEX_BRACKETED = re.compile(r"\[(.+?)\]")
+REGEX_SPACES = re.compile(r"(?:###|@@@|\s)+")
+REGEX_DIGITS_ASTERISK = re.compile(r"(?<=\d)\*(?=\d)")
+REGEX_DOUBLE_QUOTED = re.compile(r'"([^"]+)"')
+BOOKNAME_TRANSLATION = str.maketrans(
+    {
+        ":": "：",  # e.g. 404 00J001624 綠洲:中英文藝綜合月刊
+        "?": "□",  # WHITE SQUARE, U+25A1, for, e.g. 892 312001039388 筠清?金石文字   五卷"
+        "○": "〇",
+    }
+)
+
+REGEX_COMMA_IN_BRACKETS = re.compile(r"(（[^）]+?)(,)([^）]+?）)")
+REGEX_AUTHOR_SEPARATOR = re.compile(r"@@@|###@@@|   ")
+REGEX_NAME_SEPARATOR = re.compile(r"[，,、]")
+REGEX_LEADING_DYNASTY = re.compile(
+    r"^([（(〔[][题題][]）)〕])?[（(〔[](.{0,3}?)[]）)〕]"
+)
+
+REGEX_HEURISTIC_SPLIT = re.compile(r"^(\S+?)\s*([一二三四五六七八九十百]+[卷冊册])$")
+REGEX_MORE_SPLIT = re.compile(r"^(?P<a>.+?)( [(（]?(?P<b>\S+[册冊卷])?[)）]?)?$")
+
+
+@lru_cache(CACHE_SIZE)
+def fix_bookname_in_pagename(
+    bookname, apply_tortoise_shell_brackets_to_starting_of_title=False
+):
+    # if bookname.startswith("[") and bookname.endswith("]"):  # [四家四六]
+    #     bookname = bookname[1:-1]
+
+    if apply_tortoise_shell_brackets_to_starting_of_title and bookname.startswith("["):
+        bookname = REGEX_BRACKETED.sub(r"〔\1〕", bookname)  # [宋]...
+    bookname = REGEX_BRACKETED.sub(r"\1", bookname)
+    bookname = REGEX_SPACES.sub(" ", bookname)
+    bookname = bookname.translate(BOOKNAME_TRANSLATION)
+    # e.g. 511 006031402010229 新湖北（14.7*21.6）1
+    bookname = REGEX_DIGITS_ASTERISK.sub("×", bookname)
+    bookname = REGEX_DOUBLE_QUOTED.sub(r"“\1”", bookname)  # e.g. NLC-511-09000049
+    return bookname
+
+
+@lru_cache(CACHE_SIZE)
+def format_byline(author, apply_tortoise_shell_brackets_to_starting_of_byline=False):
+    """Format the author field of a book into one line per author for the `byline` param"""
+    assert "\uf8ff" not in author
+    byline = author
+    byline_enclosing_brackets = False
+    if author.startswith("[") and author.endswith("]"):
+        byline = byline[1:-1]
+        byline_enclosing_brackets = True
+        # assert "[" not in byline # disabled due to: 411999012181 [(明)周士佐[等]修]
+    if apply_tortoise_shell_brackets_to_starting_of_byline:
+        # e.g. "(魏)王弼,(晋)韩康伯撰   (唐)邢璹撰"
+        atsb = lambda s: REGEX_LEADING_DYNASTY.sub(r"\1〔\2〕", s)
+    else:
+        atsb = lambda s: s
+    # e.g. "（英國）韋廉臣（Williams,W.）撰"
+    byline = REGEX_COMMA_IN_BRACKETS.sub("\\1\uf8ff\\3", byline)
+    byline = " <br />\n".join(
+        " ".join(atsb(aauthor) for aauthor in REGEX_NAME_SEPARATOR.split(author))
+        for author in REGEX_AUTHOR_SEPARATOR.split(byline)
+    )
+    byline = byline.replace("\uf8ff", ",")
+    if byline_enclosing_brackets:
+        byline = "[" + byline + "]"
+    return byline
+
+
+def split_name_heuristic(name):
+    if name.endswith("不分卷"):
+        return name[:-3], "不分卷"
+    match = REGEX_HEURISTIC_SPLIT.match(name)
+    if match is None:
+        return name, ""
+    else:
+        return match.group(1), match.group(2)
+
+
+def split_name_more(name):
+    if name.endswith("不分卷"):
+        return name[:-3], "不分卷"
+    # match = re.match(r"^(\S+)( \S+[册冊卷])*", name)
+    match = REGEX_MORE_SPLIT.match(name)
+    assert match, "Invalid Book Title"
+    return match.group("a"), match.group("b") or ""
+
+
+def split_name_simple(name):
+    parts = tuple(name.split(maxsplit=1))
+    if len(parts) == 1:
+        parts += ("",)
+    return parts
@@ -0,0 +1,69 @@
+"""Batched queries for the state of pages on the wiki"""
+
+import logging
+import re
+from typing import NamedTuple, Optional
+
+from more_itertools import chunked
+from pywikibot.data.api import Request
+
+logger = logging.getLogger(__name__)
+
+# the limit of titles per query for non-bot accounts
+MAX_TITLES_PER_QUERY = 50
+
+
+class PageInfo(NamedTuple):
+    exists: bool
+    revid: Optional[int] = None
+    size: Optional[int] = None  # of the file, for file pages
+    sha1: Optional[str] = None  # of the file, for file pages
+    text: Optional[str] = None  # of the latest revision, if queried with content
+
+
+def query_pages(site, titles, content=False):
+    """Query existence, latest revision id, and file size and SHA-1 of pages
+
+    Up to `MAX_TITLES_PER_QUERY` titles go into a single request. The returned dict is keyed
+    by the titles as given, regardless of how the wiki normalizes them. With `content`, the
+    text of the latest revisions is fetched too.
+    """
+    parameters = {
+        "action": "query",
+        "prop": ["info", "imageinfo"],
+        "iiprop": ["size", "sha1"],
+        "formatversion": 2,
+    }
+    if content:
+        parameters |= {
+            "prop": parameters["prop"] + ["revisions"],
+            "rvprop": ["content"],
+            "rvslots": "main",
+        }
+    infos = {}
+    for chunk in chunked(dict.fromkeys(titles), MAX_TITLES_PER_QUERY):
+        r = Request(site=site, parameters=parameters | {"titles": chunk}).submit()[
+            "query"
+        ]
+        normalized = {n["to"]: n["from"] for n in r.get("normalized", [])}
+        for page in r["pages"]:
+            title = normalized.get(page["title"], page["title"])
+            if page.get("missing") or page.get("invalid"):
+                infos[title] = PageInfo(False)
+            else:
+                imageinfo = (page.get("imageinfo") or [{}])[0]
+                revision = (page.get("revisions") or [{}])[0]
+                infos[title] = PageInfo(
+                    True,
+                    page.get("lastrevid"),
+                    imageinfo.get("size"),
+                    imageinfo.get("sha1"),
+                    revision.get("slots", {}).get("main", {}).get("content"),
+                )
+    logger.debug(f"Queried {len(infos)} pages")
+    return infos
+
+
+def normalize_wikitext(text):
+    """Normalize wikitext for comparison, ignoring line endings and trailing whitespace"""
+    return re.sub(r"[ \t]+$", "", text.replace("\r\n", "\n"), flags=re.M).strip()
@@ -0,0 +1,160 @@
+"""Write JPEG images into a PDF page by page, without holding the document in memory"""
+
+import hashlib
+from io import BytesIO
+
+from PIL import Image
+
+# as img2pdf assumes for images without a resolution
+DEFAULT_DPI = 96.0
+
+COLOR_SPACES = {"L": "/DeviceGray", "RGB": "/DeviceRGB"}
+
+# start-of-frame markers of the baseline, extended and progressive Huffman-coded JPEGs, which
+# DCTDecode supports, unlike lossless or arithmetic-coded ones
+SUPPORTED_FRAMES = {0xC0, 0xC1, 0xC2}
+# markers of 0xC0 to 0xCF that are not start-of-frame ones
+NOT_FRAMES = {0xC4, 0xC8, 0xCC}
+
+
+class UnsupportedImage(ValueError):
+    pass
+
+
+class JpegPdfWriter:
+    """Write a PDF with each JPEG image as a page of its size, embedded as is
+
+    Pages are appended to `path` as they are added, so memory use does not grow with the
+    number of pages, apart from one xref offset per object. The SHA-1 is computed on the fly.
+    Images that are not grayscale or RGB JPEGs coded as DCTDecode supports, i.e. baseline,
+    extended or progressive with Huffman coding, or that are rotated by EXIF, raise
+    UnsupportedImage. img2pdf handles those.
+    """
+
+    CATALOG = 1
+    PAGES = 2
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+        self.offsets = {}
+        self.pages = []
+        self._write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+    def add_jpeg(self, data):
+        width, height, color_space, dpi = _inspect_jpeg(data)
+        page_width = width * 72 / dpi[0]
+        page_height = height * 72 / dpi[1]
+        image, contents, page = (len(self.offsets) + 3 + i for i in range(3))
+        self._write_object(
+            image,
+            b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s "
+            b"/BitsPerComponent 8 /Filter /DCTDecode /Length %d >>\nstream\n"
+            % (width, height, color_space.encode(), len(data)),
+            data,
+            b"\nendstream",
+        )
+        content = b"q %s 0 0 %s 0 0 cm /Im0 Do Q" % (
+            _number(page_width),
+            _number(page_height),
+        )
+        self._write_object(
+            contents,
+            b"<< /Length %d >>\nstream\n" % len(content),
+            content,
+            b"\nendstream",
+        )
+        self._write_object(
+            page,
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %s %s] "
+            b"/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>"
+            % (
+                self.PAGES,
+                _number(page_width),
+                _number(page_height),
+                image,
+                contents,
+            ),
+        )
+        self.pages.append(page)
+
+    def close(self):
+        """Finish the document, returning its size and SHA-1"""
+        kids = b" ".join(b"%d 0 R" % page for page in self.pages)
+        self._write_object(
+            self.PAGES,
+            b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.pages)),
+        )
+        self._write_object(
+            self.CATALOG, b"<< /Type /Catalog /Pages %d 0 R >>" % self.PAGES
+        )
+        xref_offset = self.size
+        count = max(self.offsets) + 1
+        self._write(b"xref\n0 %d\n0000000000 65535 f \n" % count)
+        for number in range(1, count):
+            self._write(b"%010d 00000 n \n" % self.offsets[number])
+        self._write(
+            b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (count, self.CATALOG, xref_offset)
+        )
+        self.file.close()
+        return self.size, self.sha1.hexdigest()
+
+    def _write_object(self, number, *parts):
+        self.offsets[number] = self.size
+        self._write(b"%d 0 obj\n" % number, *parts, b"\nendobj\n")
+
+    def _write(self, *parts):
+        for part in parts:
+            self.file.write(part)
+            self.sha1.update(part)
+            self.size += len(part)
+
+
+def _inspect_jpeg(data):
+    try:
+        # only the headers are parsed here
+        img = Image.open(BytesIO(data))
+    except Exception as e:
+        raise UnsupportedImage(f"Unreadable image: {e}") from e
+    if img.format != "JPEG" or img.mode not in COLOR_SPACES:
+        raise UnsupportedImage(f"Unsupported image: {img.format} {img.mode}")
+    if img.getexif().get(0x0112, 1) != 1:
+        raise UnsupportedImage("Rotated image")
+    if (frame := _frame_marker(data)) not in SUPPORTED_FRAMES:
+        raise UnsupportedImage(f"Unsupported JPEG frame: {frame and hex(frame)}")
+    dpi = img.info.get("dpi") or (DEFAULT_DPI, DEFAULT_DPI)
+    dpi = tuple(float(d) if d else DEFAULT_DPI for d in dpi)
+    return img.width, img.height, COLOR_SPACES[img.mode], dpi
+
+
+def _frame_marker(data):
+    """Find the start-of-frame marker of a JPEG, by walking its segments up to the scan"""
+    pos = 2  # after SOI
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None  # malformed
+        marker = data[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:  # without a length
+            pos += 2
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in NOT_FRAMES:
+            return marker
+        if marker == 0xDA:  # start of scan, with no frame before
+            return None
+        pos += 2 + int.from_bytes(data[pos + 2 : pos + 4], "big")
+    return None
+
+
+def _number(value):
+    return (b"%.4f" % value).rstrip(b"0").rstrip(b".")
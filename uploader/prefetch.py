@@ -0,0 +1,60 @@
+"""Overlap downloading upcoming volumes with uploading the current one"""
+
+import logging
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    """A bounded producer/consumer pipeline
+
+    Producers passed to `submit` run in a background thread, at most `depth` of them ahead of
+    the consumer. Consumers run in the calling thread in submission order, so that everything
+    talking to the wiki stays on the main thread.
+
+    With `depth` being 0, everything runs inline as if there were no prefetching at all.
+    """
+
+    def __init__(self, depth=0):
+        self.depth = depth
+        self.pending = deque()
+        self.tasks = queue.SimpleQueue()
+        if depth > 0:
+            # daemonic so that a failing batch exits without waiting for queued downloads
+            threading.Thread(target=self._work, name="prefetch", daemon=True).start()
+
+    def submit(self, produce, consume):
+        """Schedule `produce()` and then call `consume(get)` with `get()` returning (or raising)
+        what `produce()` returned (or raised)"""
+        if self.depth <= 0:
+            consume(produce)
+            return
+        future = Future()
+        self.tasks.put((future, produce))
+        self.pending.append((future, consume))
+        while len(self.pending) > self.depth:
+            self._consume_one()
+
+    def drain(self):
+        while self.pending:
+            self._consume_one()
+
+    def _consume_one(self):
+        future, consume = self.pending.popleft()
+        if not future.done():
+            logger.debug("Waiting for prefetching to catch up")
+        consume(future.result)
+
+    def _work(self):
+        while True:
+            future, produce = self.tasks.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(produce())
+            except BaseException as e:
+                future.set_exception(e)
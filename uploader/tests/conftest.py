@@ -0,0 +1,5 @@
+# the modules of the uploader are scripts, importing each other by their bare names
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
@@ -0,0 +1,48 @@
+import json
+import threading
+
+import pytest
+
+from eventlog import EventLog
+
+
+def failing_once(failure):
+    """A `publish` failing on its first call as given, e.g. returning False or raising"""
+    published = []
+    first_called = threading.Event()
+
+    def publish(events):
+        published.append([event["message"] for event in events])
+        first_called.set()
+        if len(published) == 1:
+            if isinstance(failure, Exception):
+                raise failure
+            return failure
+        return True
+
+    return publish, published, first_called
+
+
+@pytest.mark.parametrize("failure", [False, IOError("Edit conflict")])
+def test_events_failing_to_be_published_are_retried(tmp_path, failure):
+    publish, published, first_called = failing_once(failure)
+    path = tmp_path / "events.jsonl"
+    eventlog = EventLog(path, publish, flush_every=2, flush_interval=60)
+    eventlog.log("a")
+    eventlog.log("b")
+    assert first_called.wait(10)
+    eventlog.log("c")
+    # retried on close, instead of waiting out the interval after the failure
+    eventlog.close()
+    assert published == [["a", "b"], ["a", "b", "c"]]
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["message"] for line in lines] == ["a", "b", "c"]
+
+
+def test_events_failing_to_be_published_on_close_are_kept(tmp_path):
+    publish, published, _ = failing_once(False)
+    eventlog = EventLog(tmp_path / "events.jsonl", publish, flush_every=10)
+    eventlog.log("a")
+    eventlog.close()
+    assert published == [["a"]]
+    assert [event["message"] for event in eventlog.pending] == ["a"]
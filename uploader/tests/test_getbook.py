@@ -0,0 +1,267 @@
+import hashlib
+import re
+from concurrent.futures import Future
+
+import pytest
+import requests
+
+import getbook
+
+DATA = b"%PDF-" + bytes(range(256)) * 64 + b"%%EOF"
+CHUNK = 1000  # bytes per chunk sent by FakeServer
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers, body=b"", break_at=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.break_at = break_at
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code}")
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), CHUNK):
+            if self.break_at is not None and i >= self.break_at:
+                raise requests.exceptions.ChunkedEncodingError("Connection broken")
+            yield self.body[i : i + CHUNK]
+
+
+class FakeServer:
+    """Serve `data` honoring Range and If-Range as `open_response` of `stream_pdf`
+
+    `faults` are taken one per request: None to respond normally, an exception to raise
+    instead of responding, or a number of bytes after which the response breaks off.
+    """
+
+    def __init__(self, data=DATA, etag='"v1"', faults=(), ranges=True):
+        self.data = data
+        self.etag = etag
+        self.faults = list(faults)
+        self.ranges = ranges
+        self.requests = []
+
+    def __call__(self, headers):
+        self.requests.append(headers)
+        fault = self.faults.pop(0) if self.faults else None
+        if isinstance(fault, Exception):
+            raise fault
+        base = {"Content-Type": "application/pdf"}
+        if self.etag:
+            base["ETag"] = self.etag
+        range_ = re.fullmatch(r"bytes=(\d+)-(\d*)", headers.get("Range", ""))
+        if self.ranges:
+            base["Accept-Ranges"] = "bytes"
+        if_range = headers.get("If-Range")
+        if not self.ranges or not range_ or if_range not in (None, self.etag):
+            headers = base | {"Content-Length": str(len(self.data))}
+            return FakeResponse(200, headers, self.data, fault)
+        start = int(range_[1])
+        end = int(range_[2]) if range_[2] else len(self.data) - 1
+        if start >= len(self.data):
+            return FakeResponse(
+                416, base | {"Content-Range": f"bytes */{len(self.data)}"}
+            )
+        body = self.data[start : end + 1]
+        headers = base | {
+            "Content-Range": f"bytes {start}-{start + len(body) - 1}/{len(self.data)}",
+            "Content-Length": str(len(body)),
+        }
+        return FakeResponse(206, headers, body, fault)
+
+
+class SerialExecutor:
+    """A `ThreadPoolExecutor` running jobs right away, for the order of requests to be known"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+@pytest.fixture
+def spool(tmp_path, monkeypatch):
+    monkeypatch.setattr(getbook.segmenting, "threshold", None)
+    return tmp_path / "volume.pdf"
+
+
+def part_of(spool):
+    return spool.with_name(spool.name + ".part")
+
+
+def validator_of(spool):
+    return spool.with_name(spool.name + ".part.validator")
+
+
+def assert_downloaded(download, spool, data=DATA):
+    assert spool.read_bytes() == data
+    assert download.size == len(data)
+    assert download.sha1 == hashlib.sha1(data).hexdigest()
+    assert not part_of(spool).exists()
+    assert not validator_of(spool).exists()
+
+
+def test_parse_content_range():
+    assert getbook.parse_content_range("bytes 10-19/20") == (10, 20)
+    assert getbook.parse_content_range("bytes 10-19/*") == (10, None)
+    assert getbook.parse_content_range("bytes */20") == (None, 20)
+    for invalid in (None, "", "items 0-1/2"):
+        with pytest.raises(ValueError):
+            getbook.parse_content_range(invalid)
+
+
+def test_stream(spool):
+    server = FakeServer()
+    assert_downloaded(getbook.stream_pdf(server, spool), spool)
+    assert "Range" not in server.requests[0]
+
+
+def test_stream_resumes_where_broken_off(spool):
+    server = FakeServer(faults=[5000, 3000])
+    assert_downloaded(getbook.stream_pdf(server, spool), spool)
+    assert [r.get("Range") for r in server.requests] == [
+        None,
+        "bytes=5000-",
+        "bytes=8000-",
+    ]
+    assert all(r["If-Range"] == '"v1"' for r in server.requests[1:])
+
+
+def test_stream_counts_failing_resuming_requests(spool):
+    refused = requests.exceptions.ConnectionError("Connection refused")
+    server = FakeServer(faults=[5000, refused, None])
+    assert_downloaded(getbook.stream_pdf(server, spool), spool)
+
+    server = FakeServer(faults=[5000, refused, refused])
+    with pytest.raises(requests.exceptions.ConnectionError):
+        getbook.stream_pdf(server, spool.with_name("other.pdf"), max_resumes=2)
+
+
+def test_stream_does_not_resume_without_ranges(spool):
+    server = FakeServer(faults=[5000], ranges=False)
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        getbook.stream_pdf(server, spool)
+
+
+def test_stream_resumes_across_calls_with_validator(spool):
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        getbook.stream_pdf(FakeServer(faults=[5000, 1000]), spool, max_resumes=1)
+    assert part_of(spool).stat().st_size == 6000
+    assert validator_of(spool).read_text() == '"v1"'
+
+    server = FakeServer()
+    assert_downloaded(getbook.stream_pdf(server, spool), spool)
+    assert server.requests[0]["Range"] == "bytes=6000-"
+    assert server.requests[0]["If-Range"] == '"v1"'
+
+
+def test_stream_restarts_if_changed_since(spool):
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        getbook.stream_pdf(FakeServer(faults=[5000]), spool, max_resumes=0)
+
+    changed = DATA[::-1]
+    server = FakeServer(changed, etag='"v2"')
+    assert_downloaded(getbook.stream_pdf(server, spool), spool, changed)
+    assert server.requests[0]["If-Range"] == '"v1"'
+
+
+def test_stream_discards_partial_download_of_unknown_version(spool):
+    part_of(spool).write_bytes(b"stale")
+    server = FakeServer()
+    assert_downloaded(getbook.stream_pdf(server, spool), spool)
+    assert "Range" not in server.requests[0]
+
+
+def test_stream_completed_right_before_breaking_off(spool):
+    part_of(spool).write_bytes(DATA)
+    validator_of(spool).write_text('"v1"')
+    server = FakeServer()
+    assert_downloaded(getbook.stream_pdf(server, spool), spool)
+    assert len(server.requests) == 1
+
+
+@pytest.mark.parametrize("content_range", [None, "bytes */4", "garbage"])
+def test_stream_restarts_on_unsatisfiable_range(spool, content_range):
+    part_of(spool).write_bytes(DATA[:5000])
+    validator_of(spool).write_text('"v1"')
+
+    class Unsatisfiable(FakeServer):
+        def __call__(self, headers):
+            if "Range" not in headers:
+                return super().__call__(headers)
+            self.requests.append(headers)
+            headers = {} if content_range is None else {"Content-Range": content_range}
+            return FakeResponse(416, headers)
+
+    server = Unsatisfiable()
+    assert_downloaded(getbook.stream_pdf(server, spool), spool)
+    assert [r.get("Range") for r in server.requests] == ["bytes=5000-", None]
+
+
+@pytest.mark.parametrize("size", [len(DATA), 7, 4097])
+@pytest.mark.parametrize("segments", [1, 3, 4])
+def test_segmented(spool, monkeypatch, size, segments):
+    monkeypatch.setattr(getbook.segmenting, "threshold", 1)
+    monkeypatch.setattr(getbook.segmenting, "segments", segments)
+    data = DATA[:size]
+    server = FakeServer(data)
+    assert_downloaded(getbook.stream_pdf(server, spool), spool, data)
+    assert server.requests[0]["Range"] == "bytes=0-0"
+    ranges = sorted(
+        tuple(map(int, re.fullmatch(r"bytes=(\d+)-(\d+)", r["Range"]).groups()))
+        for r in server.requests[1:]
+    )
+    # contiguous and covering the whole file
+    assert ranges[0][0] == 0 and ranges[-1][1] == size - 1
+    assert all(a[1] + 1 == b[0] for a, b in zip(ranges, ranges[1:]))
+    assert len(ranges) == min(segments, size)
+
+
+def test_segmented_resumes_broken_segments(spool, monkeypatch):
+    monkeypatch.setattr(getbook.segmenting, "threshold", 1)
+    monkeypatch.setattr(getbook.segmenting, "segments", 2)
+    # the probe, and then the first segment breaking off, before the second one starts
+    server = FakeServer(faults=[None, 2000])
+    monkeypatch.setattr(getbook, "ThreadPoolExecutor", SerialExecutor)
+    assert_downloaded(getbook.stream_pdf(server, spool), spool)
+    half = -(-len(DATA) // 2)
+    assert [r["Range"] for r in server.requests[1:]] == [
+        f"bytes=0-{half - 1}",
+        f"bytes=2000-{half - 1}",
+        f"bytes={half}-{len(DATA) - 1}",
+    ]
+    assert not spool.with_name(spool.name + ".segments").exists()
+
+
+def test_segmented_falls_back_without_ranges(spool, monkeypatch):
+    monkeypatch.setattr(getbook.segmenting, "threshold", 1)
+    server = FakeServer(ranges=False)
+    assert_downloaded(getbook.stream_pdf(server, spool), spool)
+    assert len(server.requests) == 2
+
+
+def test_spool_linked_to_cached_blob_is_replaced(spool, tmp_path):
+    blob = tmp_path / "blob"
+    blob.write_bytes(b"cached")
+    spool.hardlink_to(blob)
+    assert_downloaded(getbook.stream_pdf(FakeServer(), spool), spool)
+    assert blob.read_bytes() == b"cached"
+    assert getbook.write_spool(spool, [b"a", b"b"]).size == 2
+    assert blob.read_bytes() == b"cached"
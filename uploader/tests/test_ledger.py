@@ -0,0 +1,146 @@
+import socket
+import sqlite3
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+import pytest
+
+import ledger
+from ledger import (
+    DOWNLOADED,
+    DUPLICATE,
+    FAILED,
+    FINISHED,
+    PENDING,
+    UPLOADED,
+    Ledger,
+    volume_key,
+)
+
+KEY = volume_key(" 1", 2, "3 ")
+OTHER_KEY = volume_key(1, 2, 4)
+
+
+@pytest.fixture
+def ledger_(tmp_path):
+    return Ledger(tmp_path / "ledger.sqlite3")
+
+
+def row(ledger_, key, *columns):
+    return ledger_.conn.execute(
+        f"SELECT {', '.join(columns)} FROM volumes"
+        " WHERE (dbid, bookid, volumeid) = (?, ?, ?)",
+        key,
+    ).fetchone()
+
+
+def dead_worker():
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    return f"{socket.gethostname()}:{process.pid}:MainThread"
+
+
+def test_volume_key_is_normalized():
+    assert KEY == ("1", "2", "3")
+
+
+def test_states_and_attempts(ledger_):
+    ledger_.start(KEY, "File:A.pdf")
+    assert row(ledger_, KEY, "state", "attempts") == (PENDING, 1)
+    ledger_.mark(KEY, DOWNLOADED, size=123, sha1="abc")
+    ledger_.mark(KEY, FAILED, error="boom")
+    ledger_.start(KEY)
+    assert row(ledger_, KEY, "state", "attempts", "error") == (PENDING, 2, None)
+    ledger_.mark(KEY, UPLOADED)
+    # kept from earlier marks unless given again
+    assert row(ledger_, KEY, "pagename", "size", "sha1") == ("File:A.pdf", 123, "abc")
+    ledger_.mark(OTHER_KEY, DUPLICATE)
+    assert ledger_.keys(FINISHED) == {KEY, OTHER_KEY}
+    assert ledger_.keys([FAILED]) == set()
+    assert ledger_.summary() == {DUPLICATE: 1, UPLOADED: 1}
+    assert len(ledger_) == 2
+
+
+def test_find_uploaded(ledger_):
+    ledger_.mark(KEY, DOWNLOADED, "File:A.pdf", sha1="abc")
+    assert ledger_.find_uploaded("abc") is None
+    ledger_.mark(KEY, UPLOADED)
+    assert ledger_.find_uploaded("abc") == "File:A.pdf"
+    assert ledger_.find_uploaded("abc", exclude=KEY) is None
+    assert ledger_.find_uploaded("def") is None
+
+
+def test_claim_is_exclusive_until_finished(ledger_):
+    assert ledger_.claim(KEY, "host:1:a")
+    assert ledger_.claim(KEY, "host:1:a")
+    assert not ledger_.claim(KEY, "host:1:b")
+    # still being worked on
+    ledger_.mark(KEY, DOWNLOADED)
+    assert not ledger_.claim(KEY, "host:1:b")
+    ledger_.mark(KEY, FAILED)
+    assert ledger_.claim(KEY, "host:1:b")
+    ledger_.mark(KEY, UPLOADED)
+    assert row(ledger_, KEY, "claimed_by", "claimed_at") == (None, None)
+    # e.g. by another process, which loaded the finished volumes before
+    assert not ledger_.claim(KEY, "host:1:b")
+    ledger_.mark(OTHER_KEY, DUPLICATE)
+    assert not ledger_.claim(OTHER_KEY, "host:1:b")
+    assert ledger_.claim(KEY, "host:1:b", refresh=True)
+
+
+def test_claim_expires(ledger_, monkeypatch):
+    assert ledger_.claim(KEY, "host:1:a")
+    monkeypatch.setattr(ledger, "CLAIM_TIMEOUT", -ledger.CLAIM_TIMEOUT)
+    assert ledger_.claim(KEY, "host:1:b")
+
+
+def test_claim_of_dead_process_is_taken_over(ledger_):
+    assert ledger_.claim(KEY, dead_worker())
+    assert ledger_.claim(KEY, ledger.worker_id())
+
+
+def test_claim_of_live_process_is_kept(ledger_):
+    # of init, always running on this host, and of a process on another host
+    assert ledger_.claim(KEY, f"{socket.gethostname()}:1:MainThread")
+    assert not ledger_.claim(KEY, ledger.worker_id())
+    assert ledger_.claim(OTHER_KEY, dead_worker().replace(socket.gethostname(), "x"))
+    assert not ledger_.claim(OTHER_KEY, ledger.worker_id())
+
+
+def test_release(ledger_):
+    # e.g. after an interrupted run, which leaves volumes pending
+    ledger_.claim(KEY, ledger.worker_id())
+    ledger_.start(KEY)
+    ledger_.claim(OTHER_KEY, "x:1:MainThread")
+    assert ledger_.release() == 1
+    assert ledger_.claim(KEY, "x:2:MainThread")
+    assert not ledger_.claim(OTHER_KEY, "x:2:MainThread")
+    assert row(ledger_, KEY, "state") == (PENDING,)
+
+
+def test_migrates_older_ledgers(tmp_path):
+    path = tmp_path / "ledger.sqlite3"
+    conn = sqlite3.connect(path)
+    conn.execute("""CREATE TABLE volumes (
+            dbid TEXT NOT NULL,
+            bookid TEXT NOT NULL,
+            volumeid TEXT NOT NULL,
+            pagename TEXT,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            size INTEGER,
+            error TEXT,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (dbid, bookid, volumeid)
+        )""")
+    conn.execute(
+        "INSERT INTO volumes (dbid, bookid, volumeid, state, updated_at)"
+        " VALUES (?, ?, ?, ?, ?)",
+        (*KEY, UPLOADED, datetime.now(timezone.utc).isoformat()),
+    )
+    conn.commit()
+    conn.close()
+    ledger_ = Ledger(path)
+    assert ledger_.keys(FINISHED) == {KEY}
+    assert ledger_.claim(OTHER_KEY, "host:1:a")
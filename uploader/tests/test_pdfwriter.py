@@ -0,0 +1,88 @@
+import hashlib
+import re
+from io import BytesIO
+
+import img2pdf
+import pytest
+from PIL import Image
+
+from pdfwriter import JpegPdfWriter, UnsupportedImage
+
+
+def jpeg(mode="RGB", size=(50, 60), **params):
+    output = BytesIO()
+    Image.new(mode, size).save(output, format="JPEG", **params)
+    return output.getvalue()
+
+
+def rotated_exif():
+    exif = Image.Exif()
+    exif[0x0112] = 6  # orientation: rotated by 90 degrees
+    return exif.tobytes()
+
+
+def with_frame_marker(data, marker):
+    # e.g. as a lossless or arithmetic-coded JPEG would start its frame
+    return data.replace(b"\xff\xc0", bytes([0xFF, marker]), 1)
+
+
+def media_boxes(pdf):
+    return [
+        tuple(map(float, box.split()))
+        for box in re.findall(rb"/MediaBox \[\s*([^\]]*?)\s*\]", pdf)
+    ]
+
+
+def test_pages_as_img2pdf(tmp_path):
+    images = [
+        jpeg(),
+        jpeg("L", (70, 30)),
+        jpeg(size=(50, 60), dpi=(300, 300)),
+        jpeg(progressive=True),
+    ]
+    path = tmp_path / "volume.pdf"
+    with JpegPdfWriter(path) as pdf:
+        for image in images:
+            pdf.add_jpeg(image)
+        size, sha1 = pdf.close()
+
+    data = path.read_bytes()
+    assert (size, sha1) == (len(data), hashlib.sha1(data).hexdigest())
+    assert data.startswith(b"%PDF-") and data.endswith(b"%%EOF\n")
+    assert media_boxes(data) == media_boxes(img2pdf.convert(images))
+    # embedded as is
+    assert all(image in data for image in images)
+
+
+def test_xref_points_at_objects(tmp_path):
+    path = tmp_path / "volume.pdf"
+    with JpegPdfWriter(path) as pdf:
+        pdf.add_jpeg(jpeg())
+        pdf.add_jpeg(jpeg())
+        pdf.close()
+
+    data = path.read_bytes()
+    xref_offset = int(re.search(rb"startxref\n(\d+)\n", data)[1])
+    xref = data[xref_offset:].split(b"trailer")[0].splitlines()
+    assert xref[:2] == [b"xref", b"0 9"]
+    for number, entry in enumerate(xref[3:], start=1):
+        offset = int(entry.split()[0])
+        assert data[offset:].startswith(b"%d 0 obj\n" % number)
+    assert b"/Count 2" in data
+
+
+@pytest.mark.parametrize(
+    "image",
+    [
+        jpeg("CMYK"),
+        jpeg(exif=rotated_exif()),
+        with_frame_marker(jpeg(), 0xC3),
+        with_frame_marker(jpeg(), 0xC9),
+        b"\x89PNG\r\n\x1a\n",
+    ],
+    ids=["cmyk", "rotated", "lossless", "arithmetic", "not-jpeg"],
+)
+def test_unsupported_images(tmp_path, image):
+    with JpegPdfWriter(tmp_path / "volume.pdf") as pdf:
+        with pytest.raises(UnsupportedImage):
+            pdf.add_jpeg(image)
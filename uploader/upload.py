@@ -1,17 +1,19 @@
 #!/usr/bin/env python3
 import os.path
+import argparse
+import atexit
 import itertools
 import subprocess
 import json
 import logging
-from io import BytesIO
 import os
 import functools
 import re
 import sys
+import threading
+import time
 from itertools import chain
 from functools import lru_cache
-from datetime import datetime, timezone
 from unicodedata import name
 from more_itertools import peekable
 from typing import Literal
@@ -24,13 +26,47 @@ import pywikibot, pywikibot.exceptions
 import internetarchive as ia
 from mwclient_contenttranslation import CxTranslator
 
-from getbook import getbook
+from getbook import (
+    getbook,
+    nlc_rate_limiter,
+    nlc_session,
+    doc_mirrors,
+    segmenting,
+    remove_page_spool,
+    DOWNLOAD_STRATEGIES,
+)
+from prefetch import Prefetcher
+from workers import WorkerPool
+from dlcache import DownloadCache, cache_key, parse_size
+from pageinfo import query_pages, normalize_wikitext, PageInfo
+from eventlog import EventLog
+from httppool import DEFAULT_TIMEOUT, DEFAULT_POOL_SIZE
+from normalize import (
+    fix_bookname_in_pagename,
+    format_byline,
+    split_name_heuristic,
+    split_name_more,
+    split_name_simple,
+)
+from ledger import (
+    Ledger,
+    volume_key,
+    worker_id,
+    DOWNLOADED,
+    UPLOADED,
+    FAILED,
+    DUPLICATE,
+    FINISHED,
+)
 
 CONFIG_FILE_PATH = os.path.join(os.path.dirname(__file__), "config.yml")
 POSITION_FILE_PATH = os.path.join(os.path.dirname(__file__), ".position")
+LEDGER_FILE_PATH = os.path.join(os.path.dirname(__file__), ".ledger")
+EVENTLOG_FILE_PATH = os.path.join(os.path.dirname(__file__), ".eventlog")
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 NAME_CAP_FIX_PATH = os.path.join(DATA_DIR, "namecapfix.yml")
 CACHE_FILE_DIR = Path(__file__).parent
+DOWNLOAD_CACHE_DIR = CACHE_FILE_DIR / ".dlcache"
 CHUNK_SIZE = 32 * 1024 * 1024
 ASYNC_UPLOAD_THRESHOLD = 128 * 1024 * 1024
 RETRY_TIMES = 3
@@ -53,6 +89,7 @@ def call(command, *args, **kwargs):
 
 
 def load_position(name):
+    """Load the legacy position file, superseded by the ledger"""
     logger.info(f'Loading position from {POSITION_FILE_PATH + "." + name}')
     if os.path.exists(POSITION_FILE_PATH + "." + name):
         with open(POSITION_FILE_PATH + "." + name, "r") as f:
@@ -61,22 +98,15 @@ def load_position(name):
         return None
 
 
-def store_position(name, position):
-    with open(POSITION_FILE_PATH + "." + name, "w") as f:
-        f.write(position)
-
-
 def retry(times=RETRY_TIMES):
     def wrapper(fn):
-        tried = 0
-
         @functools.wraps(fn)
         def wrapped(*args, **kwargs):
+            tried = 0  # per call, as calls may run concurrently in workers
             while True:
                 try:
                     return fn(*args, **kwargs)
                 except Exception as e:
-                    nonlocal tried
                     tried += 1
                     if tried >= times:
                         raise Exception(f"Failed finally after {times} tries") from e
@@ -108,7 +138,9 @@ def gen_toc(toc):
 
 
 @retry()
-def getbook_unified(volume, secondary=False, proxies=None):
+def getbook_unified(
+    volume, spool_path, secondary=False, proxies=None, cache=None, strategy="token"
+):
     logger.debug(f"Fetching {volume}")
     # if "fileiplogger.info("Failed to get file by path: " + str(e), ", fallbacking to getbook")
     volume_id = volume["id"] if not secondary else volume["secondary_volume"]["id"]
@@ -117,80 +149,77 @@ def getbook_unified(volume, secondary=False, proxies=None):
         if not secondary
         else volume["secondary_volume"]["file_path"]
     )
-    b = getbook(
-        volume["of_collection_name"].removeprefix("data_"),
-        volume_id,
-        file_path,
-        proxies,
+    collection = volume["of_collection_name"].removeprefix("data_")
+    key = cache_key(collection, volume_id, file_path)
+    if cache is not None and (cached := cache.get(key, spool_path)):
+        logger.info(f"Got {collection},{volume_id} from download cache")
+        return cached
+    downloaded = getbook(
+        collection, volume_id, spool_path, file_path, proxies, strategy
     )
-    return b
-
-
-def split_name_heuristic(name):
-    if name.endswith("不分卷"):
-        return name[:-3], "不分卷"
-    match = re.match(r"^(\S+?)\s*([一二三四五六七八九十百]+[卷冊册])$", name)
-    if match is None:
-        return name, ""
-    else:
-        return match.group(1), match.group(2)
-
-
-def split_name_more(name):
-    if name.endswith("不分卷"):
-        return name[:-3], "不分卷"
-    # match = re.match(r"^(\S+)( \S+[册冊卷])*", name)
-    match = re.match(r"^(?P<a>.+?)( [(（]?(?P<b>\S+[册冊卷])?[)）]?)?$", name)
-    assert match, "Invalid Book Title"
-    return match.group("a"), match.group("b") or ""
-
-
-def split_name_simple(name):
-    parts = tuple(name.split(maxsplit=1))
-    if len(parts) == 1:
-        parts += ("",)
-    return parts
-
-
-def fix_bookname_in_pagename(
-    bookname, apply_tortoise_shell_brackets_to_starting_of_title=False
-):
-    # if bookname.startswith("[") and bookname.endswith("]"):  # [四家四六]
-    #     bookname = bookname[1:-1]
-
-    if apply_tortoise_shell_brackets_to_starting_of_title and bookname.startswith("["):
-        bookname = re.sub(r"\[(.+?)\]", r"〔\1〕", bookname)  # [宋]...
-    bookname = re.sub(r"\[(.+?)\]", r"\1", bookname)
-    bookname = bookname.replace(":", "：")  # e.g. 404 00J001624 綠洲:中英文藝綜合月刊
-    bookname = bookname.replace("###", " ").replace("@@@", " ")
-    bookname = re.sub(r"\s+", " ", bookname)
-    bookname = bookname.replace("?", "□").replace(
-        "○", "〇"
-    )  # WHITE SQUARE, U+25A1, for, e.g. 892 312001039388 筠清?金石文字   五卷"
-    bookname = re.sub(
-        r"(?<=\d)\*(?=\d)", "×", bookname
-    )  # e.g. 511 006031402010229 新湖北（14.7*21.6）1
-    bookname = re.sub(r'"([^"]+)"', r"“\1”", bookname)  # e.g. NLC-511-09000049
-    return bookname
+    if cache is not None:
+        cache.put(key, downloaded)
+    return downloaded
 
 
 def main():
     with open(CONFIG_FILE_PATH, "r") as f:
         config = yaml.safe_load(f.read())
 
-    if len(sys.argv) < 2:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("batch", nargs="?")
+    parser.add_argument("--ia", action="store_true", help="upload to Internet Archive")
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        metavar="N",
+        help="download up to N upcoming volumes while uploading the current one",
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="only process volumes recorded as failed in the ledger",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="process all volumes, including those recorded as finished in the ledger",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        metavar="N",
+        help="process N volumes at a time in worker threads (Commons only)",
+    )
+    parser.add_argument(
+        "--render-only",
+        metavar="MANIFEST",
+        help="write the pages of all volumes to MANIFEST as JSON lines, without network access",
+    )
+    args = parser.parse_args()
+    if args.workers > 1 and args.prefetch > 0:
+        parser.error("--prefetch and --workers are mutually exclusive")
+    if args.render_only and args.ia:
+        parser.error("--render-only is for Commons only")
+    if args.render_only and args.retry_failed:
+        parser.error("--render-only renders all volumes, without reading the ledger")
+
+    if args.batch is None:
         exit(
             f"Not batch specified.\n\nAvailable: {', '.join(list(config['batchs'].keys()))}"
         )
-    batch_name = sys.argv[1]
-    up2ia = len(sys.argv) >= 3 and sys.argv[2].strip() == "--ia"
-
-    cache_file_path = CACHE_FILE_DIR / f".cache.{batch_name}.pdf"
+    batch_name = args.batch
+    up2ia = args.ia
+    render_only = args.render_only
 
     site: mwclient.Site = None  # to make linter happy
     cxtrans: CxTranslator = None
     translate_bookname_and_byline = lambda a, b: None
-    if not up2ia:
+    if render_only:
+        logger.info(f"Rendering into {render_only} without signing in")
+    elif not up2ia:
         # username, password = config["username"], config["password"]
         site = pywikibot.Site("commons")
         site.login()
@@ -234,6 +263,43 @@ def main():
         return config["batchs"][batch_name].get(item, config.get(item, default))
 
     nlc_proxies = getopt("nlc_proxies", None)
+    download_strategy = getopt("download_strategy", "token")
+    assert (
+        download_strategy in DOWNLOAD_STRATEGIES
+    ), f"Invalid download_strategy: {download_strategy}"
+
+    dlcache = None
+    if not render_only and (
+        download_cache_budget := parse_size(getopt("download_cache_budget", 0))
+    ):
+        dlcache = DownloadCache(
+            getopt("download_cache_dir", DOWNLOAD_CACHE_DIR), download_cache_budget
+        )
+
+    def find_duplicate(sha1, key):
+        """Find an existing file with the same content, among those uploaded in the batch
+        and then on Commons"""
+        if pagename := ledger.find_uploaded(sha1, exclude=key):
+            return pagename
+        for filepage in site.allimages(sha1=sha1, total=1):
+            return filepage.title()
+        return None
+
+    def spool_path_for(dbid, bookid, volumeid):
+        # one spool file per volume, as several may be in flight at once
+        return CACHE_FILE_DIR / f".cache.{batch_name}.{dbid}-{bookid}-{volumeid}.pdf"
+
+    # pywikibot throttles requests to Commons across threads (and processes) by itself
+    nlc_rate_limiter.min_interval = getopt("nlc_min_interval", 0)
+    doc_mirrors.hedge_after = getopt("doc_server_hedge_after", None)
+    segmenting.threshold = parse_size(getopt("segmented_download_threshold", 0))
+    segmenting.segments = getopt("segmented_download_segments", 4)
+    nlc_session.configure(
+        timeout=getopt("nlc_timeout", DEFAULT_TIMEOUT),
+        pool_size=getopt("nlc_pool_size", DEFAULT_POOL_SIZE),
+        pool_sizes=getopt("nlc_pool_sizes", None),
+        proxies=nlc_proxies,
+    )
 
     with open(os.path.join(DATA_DIR, batch_name + ".json")) as f:
         books = json.load(f)
@@ -283,41 +349,113 @@ def main():
 
     iacollection = getopt("iacollection", "test_collection")
     ia_subject_from_metadata_field = getopt("ia_subject_from_metadata_field", "主題")
-    ia_publisher_from_metadata_field = getopt("ia_publisher_from_metadata_field", "出版者")
-    ia_pubdate_from_metadata_field = getopt("ia_pubdate_from_metadata_field", "出版時間")
+    ia_publisher_from_metadata_field = getopt(
+        "ia_publisher_from_metadata_field", "出版者"
+    )
+    ia_pubdate_from_metadata_field = getopt(
+        "ia_pubdate_from_metadata_field", "出版時間"
+    )
     ia_title_pinyin_from_metadata_field = getopt(
         "ia_title_pinyin_from_metadata_field", "拼音題名"
     )
     abstract_from_metadata_field = getopt("abstract_from_metadata_field", "摘要")
 
-    def log_to_remote(l):
-        if up2ia:
-            return  # TODO: no remote logging when up2ia
-        # NOTE: possible racing condition since no sync & lock
-        d = str(datetime.now(timezone.utc))
+    def publish_events(events):
+        # append only, instead of re-saving the whole page for every event
         page = pywikibot.Page(site, log_page_name)
-        wikitext = ""
-        if page.exists():
-            wikitext = page.text
-        wikitext += f"\n* <code>{d} - {batch_name}</code> " + l + "\n"
-        logger.debug(f"add log to wiki: {l}")
-        page.text = wikitext
-        page.save(f"Log (batch:nlc; {batch_link}): {l}")
+        summary = events[0]["message"] if len(events) == 1 else f"{len(events)} events"
+        return site.editpage(
+            page,
+            f"Log (batch:nlc; {batch_link}): {summary}",
+            appendtext="".join(
+                f"\n* <code>{e['time']} - {batch_name}</code> {e['message']}\n"
+                for e in events
+            ),
+        )
 
-    last_position = load_position(batch_name)
+    # a dry render leaves no state behind, neither in the event log nor in the ledger
+    eventlog = ledger = None
+    if not render_only:
+        eventlog = EventLog(
+            f"{EVENTLOG_FILE_PATH}.{batch_name}{'.ia' if up2ia else ''}.jsonl",
+            # TODO: no remote logging when up2ia
+            publish=None if up2ia else publish_events,
+            flush_every=getopt("log_flush_every", 20),
+            flush_interval=getopt("log_flush_interval", 600),
+        )
+        # publish what is pending even if the batch is aborted by an exception
+        atexit.register(eventlog.close)
 
-    if last_position is not None:
+        ledger = Ledger(
+            f"{LEDGER_FILE_PATH}.{batch_name}{'.ia' if up2ia else ''}.sqlite3"
+        )
+        logger.info(f"Ledger loaded from {ledger.path}: {ledger.summary()}")
+        # release claims on volumes left unfinished even if the batch is aborted, e.g. by
+        # Ctrl-C, so that the next run takes them over
+        atexit.register(ledger.release)
+    if render_only:
+        should_process = lambda key: True
+    elif args.retry_failed:
+        retrying = ledger.keys([FAILED])
+        logger.info(f"Retrying {len(retrying)} failed volumes")
+        should_process = lambda key: key in retrying
+    else:
+        finished = set() if args.refresh else ledger.keys(FINISHED)
+        should_process = lambda key: key not in finished
+
+    if (
+        not render_only
+        and not len(ledger)
+        and (last_position := load_position(batch_name)) is not None
+    ):
+        # migrate from the legacy position file
         books = iter(books)
         logger.info(f"Last processed: {last_position}")
         next(
             itertools.dropwhile(lambda book: str(book["id"]) != last_position, books)
         )  # lazy!
-        # TODO: peek and report?
 
     failcnt = 0
+    unchanged_cnt = 0
+    # guards the counters above, as volumes may be processed in worker threads
+    counters_lock = threading.Lock()
+    prefetcher = Prefetcher(args.prefetch if not up2ia and not render_only else 0)
+    workers = WorkerPool(args.workers if not up2ia and not render_only else 1)
+
+    manifest = open(render_only, "w", encoding="utf-8") if render_only else None
+    rendered_cnt = 0
+    start_time = time.monotonic()
+
+    def submit_volume(
+        do_upload,
+        filename,
+        pagename,
+        volume_wikitext,
+        comment,
+        secondary=False,
+        **pairing,
+    ):
+        if manifest is None:
+            workers.submit(
+                do_upload,
+                filename,
+                pagename,
+                volume_wikitext,
+                comment,
+                secondary=secondary,
+            )
+            return
+        nonlocal rendered_cnt
+        rendered_cnt += 1
+        record = {
+            "pagename": pagename,
+            "wikitext": volume_wikitext,
+            "comment": comment,
+            "secondary": secondary,
+        } | pairing
+        manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
 
     for book in books:
-        assert "\uf8ff" not in book["author"]
         if '"' in (
             author := book["misc_metadata"].get(
                 "責任者", book["misc_metadata"].get("责任者", "")
@@ -329,33 +467,10 @@ def main():
             # there is a double quote in the value
             # so just fallback to the latter field here
             book["author"] = author.replace("   ", " ")
-        byline = book["author"]
-        byline_enclosing_brackets = False
-        if book["author"].startswith("[") and book["author"].endswith("]"):
-            byline = byline[1:-1]
-            byline_enclosing_brackets = True
-            # assert "[" not in byline # disabled due to: 411999012181 [(明)周士佐[等]修]
-        if getopt("apply_tortoise_shell_brackets_to_starting_of_byline", False):
-            # e.g. "(魏)王弼,(晋)韩康伯撰   (唐)邢璹撰"
-            atsb = lambda s: re.sub(
-                r"^([（(〔[][题題][]）)〕])?[（(〔[](.{0,3}?)[]）)〕]",
-                r"\1〔\2〕",
-                s,
-            )
-        else:
-            atsb = lambda s: s
-        # e.g. "（英國）韋廉臣（Williams,W.）撰"
-        byline = re.sub(r"(（[^）]+?)(,)([^）]+?）)", "\\1\uf8ff\\3", byline)
-        byline = " <br />\n".join(
-            " ".join(atsb(aauthor) for aauthor in re.split(r"[，,、]", author))
-            for author in re.split(
-                r"@@@|###@@@|   ",
-                byline,
-            )
+        byline = format_byline(
+            book["author"],
+            getopt("apply_tortoise_shell_brackets_to_starting_of_byline", False),
         )
-        byline = byline.replace("\uf8ff", ",")
-        if byline_enclosing_brackets:
-            byline = "[" + byline + "]"
         title, note_in_title = split_name(
             book["name"].replace("?", "□").replace("○", "〇")
         )
@@ -398,6 +513,20 @@ def main():
         volumes = book["volumes"]
         volumes.sort(key=lambda e: e["index_in_book"])
 
+        volume_ids = [volume["id"] for volume in volumes]
+        if not up2ia:
+            volume_ids += [
+                volume["secondary_volume"]["id"]
+                for volume in volumes
+                if volume.get("secondary_volume")
+            ]
+        if not any(
+            should_process(volume_key(dbid, book["id"], volume_id))
+            for volume_id in volume_ids
+        ):
+            logger.debug(f'Skipping {dbid},{book["id"]}, all volumes done')
+            continue
+
         def get_volume_name_for_filename(volume, last_volume):
             if not (
                 len(volumes) > 1
@@ -419,9 +548,9 @@ def main():
                 )
             else:
                 if last_volume and last_volume["name"]:
-                    assert re.match(r"^第\d+[册冊卷]$", last_volume["name"]), last_volume[
-                        "name"
-                    ]
+                    assert re.match(
+                        r"^第\d+[册冊卷]$", last_volume["name"]
+                    ), last_volume["name"]
                     unit = last_volume["name"][-1]
                 else:
                     unit = "冊"
@@ -441,24 +570,6 @@ def main():
                 category_name = "Category:" + overwriting_categories[k]
             else:
                 category_name = "Category:" + fix_bookname_in_pagename(title)
-            category_page = pywikibot.Page(site, category_name)
-            # TODO: for now we do not create a seperated category suffixed with the edition
-            if not category_page.exists():
-                category_wikitext = (
-                    """{{Wikidata Infobox}}
-{{Category for book|zh}}
-{{zh|%s}}
-
-[[Category:Chinese-language books by title]]
-"""
-                    % title
-                )
-                # if int(dbid) == 496:
-                #     category_wikitext += "[[Category:Newspapers of the Republic of China (1912–1949)]]\n"
-                category_page.text = category_wikitext
-                category_page.save(
-                    f"Creating (batch task; nlc:{book['of_collection_name']},{book['id']})",
-                )
 
             def genvols():
                 seen_file_paths = set()
@@ -513,7 +624,41 @@ def main():
                         secondary_task,
                     )
 
-            volsit = peekable(genvols())
+            vols = list(genvols())
+            # look up all pages of the book at once rather than one by one
+            titles = [category_name]
+            for volume, *_, pagename, secondary_task in vols:
+                if should_process(volume_key(dbid, book["id"], volume["id"])):
+                    titles.append(pagename)
+                if secondary_task and should_process(
+                    volume_key(dbid, book["id"], secondary_task[0]["id"])
+                ):
+                    titles.append(secondary_task[3])
+            if render_only:
+                page_infos = {}
+            else:
+                # with the current wikitext to diff against, when refreshing existing pages
+                page_infos = query_pages(
+                    site, titles, content=not getopt("skip_on_existing", False)
+                )
+
+                category_page = pywikibot.Page(site, category_name)
+                # TODO: for now we do not create a seperated category suffixed with the edition
+                if not page_infos[category_name].exists:
+                    category_wikitext = """{{Wikidata Infobox}}
+{{Category for book|zh}}
+{{zh|%s}}
+
+[[Category:Chinese-language books by title]]
+""" % title
+                    # if int(dbid) == 496:
+                    #     category_wikitext += "[[Category:Newspapers of the Republic of China (1912–1949)]]\n"
+                    category_page.text = category_wikitext
+                    category_page.save(
+                        f"Creating (batch task; nlc:{book['of_collection_name']},{book['id']})",
+                    )
+
+            volsit = peekable(vols)
             prev_filename = None
             prev_secondary_filename = None
             for (
@@ -549,68 +694,93 @@ def main():
                         next_secondary_task = None
 
                 def do_upload(
-                    filename, pagename, volume_wikitext, comment, secondary=False
+                    filename,
+                    pagename,
+                    volume_wikitext,
+                    comment,
+                    secondary=False,
+                    # bound early as it may run in a worker after the loop moves on
+                    volume=volume,
+                    book=book,
+                    dbid=dbid,
+                    page_infos=page_infos,
                 ):
-                    nonlocal failcnt
+                    nonlocal unchanged_cnt
                     assert all(char not in set(r'["$*|\]</^>@#') for char in filename)
+                    volume_id = (
+                        volume["id"]
+                        if not secondary
+                        else volume["secondary_volume"]["id"]
+                    )
+                    key = volume_key(dbid, book["id"], volume_id)
+                    if not should_process(key):
+                        logger.debug(f"{pagename} done as per the ledger, skipping")
+                        return
+                    if not ledger.claim(key, worker_id(), refresh=args.refresh):
+                        logger.info(
+                            f"{pagename} claimed or finished by another worker, skipping"
+                        )
+                        return
                     page = pywikibot.FilePage(site, pagename)
+
+                    def on_failure(e):
+                        nonlocal failcnt
+                        with counters_lock:
+                            failcnt += 1
+                        ledger.mark(key, FAILED, error=repr(e))
+                        eventlog.log(f"[[:{pagename}]] upload failed")
+                        logger.warning("Upload failed", exc_info=e)
+                        if not getopt("skip_on_failures", False):
+                            raise e
+                        # the pages kept for a retry are not to pile up across a batch
+                        remove_page_spool(spool_path_for(dbid, book["id"], volume_id))
+
+                    job = None
                     try:
-                        if not page.exists():  # or not page.imageinfo:
-                            volume_id = (
-                                volume["id"]
-                                if not secondary
-                                else volume["secondary_volume"]["id"]
-                            )
+                        if pagename in page_infos:
+                            exists = page_infos[pagename].exists
+                        else:
+                            exists = page.exists()  # or not page.imageinfo
+                        if not exists:
+                            ledger.start(key, pagename)
                             note = " (secondary)" if secondary else ""
-                            logger.info(
-                                f'Downloading {dbid},{book["id"]},{volume_id}{note}'
+                            volume_label = f'{dbid},{book["id"]},{volume_id}{note}'
+                            spool_path = spool_path_for(dbid, book["id"], volume_id)
+                            fetch = functools.partial(
+                                getbook_unified,
+                                volume,
+                                spool_path,
+                                secondary,
+                                nlc_proxies,
+                                dlcache,
+                                download_strategy,
                             )
-                            binary = getbook_unified(volume, secondary, nlc_proxies)
-                            with open(cache_file_path, "wb") as f:
-                                f.write(binary)
-                            # https://stackoverflow.com/a/17280876/5488616
-                            size = len(binary)
-                            if size < MINIMUM_VALID_PDF_SIZE:
-                                log_to_remote(
-                                    f"[[:{pagename}]] is too small ({size} < {MINIMUM_VALID_PDF_SIZE}) to be well-formed"
-                                )
-                                raise Exception(
-                                    f"PDF is too small ({size} < {MINIMUM_VALID_PDF_SIZE})"
+
+                            def download():
+                                logger.info(f"Downloading {volume_label}")
+                                downloaded = fetch()
+                                ledger.mark(
+                                    key,
+                                    DOWNLOADED,
+                                    size=downloaded.size,
+                                    sha1=downloaded.sha1,
                                 )
-                            logger.info(f"Uploading {pagename} ({size} B)")
+                                return downloaded
 
-                            @retry()
-                            def do1():
-                                e = None
+                            def upload(downloaded):
                                 try:
-                                    r = site.upload(
-                                        source_filename=cache_file_path,
-                                        filepage=page,
-                                        text=volume_wikitext,
-                                        comment=comment,
-                                        asynchronous=size > ASYNC_UPLOAD_THRESHOLD,
-                                        chunk_size=CHUNK_SIZE,
-                                        ignore_warnings=["was-deleted"],
-                                        # report_success=True,
-                                    )
-                                    assert r
-                                except pywikibot.exceptions.UploadError as e:
-                                    e = e
-                                    pass
-                                # r = r or {}
-                                if e:
-                                    if (
-                                        e.code == "was-deleted"
-                                    ):  # r.get("warnings", {}).get("exists"):
-                                        logger.warning(
-                                            "Conflicts with existing page. Is there another worker running in parallel?"
+                                    # https://stackoverflow.com/a/17280876/5488616
+                                    size = downloaded().size
+                                    if size < MINIMUM_VALID_PDF_SIZE:
+                                        eventlog.log(
+                                            f"[[:{pagename}]] is too small ({size} < {MINIMUM_VALID_PDF_SIZE}) to be well-formed"
+                                        )
+                                        raise Exception(
+                                            f"PDF is too small ({size} < {MINIMUM_VALID_PDF_SIZE})"
                                         )
-                                    elif (
-                                        e.code == "duplicate"
-                                    ):  # dup := r.get("warnings", {}).get("duplicate"):
-                                        # assert len(dup) == 1, f"{dup}"
-                                        # dup = dup[0]
-                                        dup = e.msg
+                                    logger.info(f"Uploading {pagename} ({size} B)")
+
+                                    def redirect_to_duplicate(dup):
                                         if dup.startswith("File:"):
                                             dup = dup[5:]
                                         if dup.startswith(
@@ -625,30 +795,98 @@ def main():
                                             page.text = (
                                                 f"#REDIRECT [[File:{dup}]]\n\n<!--\n"
                                                 + volume_wikitext
-                                                + "\n-->",
+                                                + "\n-->"
                                             )
-                                            r = page.save(
+                                            page.save(
                                                 comment
                                                 + f" (Redirecting to [[File:{dup}]])",
                                             )
-                                        assert r, "Redirection failed"
-                                        # assert (
-                                        #     r.get("result") == "Success"
-                                        # ), f"Redirection failed {r}"
-                                        log_to_remote(
+                                        eventlog.log(
                                             f"[[:{pagename}]] duplicates with the existing [[:File:{dup}]] ({size}B)"
                                         )
-                                else:
-                                    # assert (
-                                    #     r.get("result")
-                                    #     or r.get("upload", {}).get("result")
-                                    # ) == "Success", f"Upload failed {r}"
-                                    assert r, "Upload failed"
-
-                            do1()
+                                        return DUPLICATE
+
+                                    # skip uploading any bytes if the content is known already
+                                    if dup := find_duplicate(downloaded().sha1, key):
+                                        ledger.mark(key, redirect_to_duplicate(dup))
+                                        remove_page_spool(spool_path)
+                                        return
+
+                                    @retry()
+                                    def do1():
+                                        e = None
+                                        try:
+                                            r = site.upload(
+                                                source_filename=spool_path,
+                                                filepage=page,
+                                                text=volume_wikitext,
+                                                comment=comment,
+                                                asynchronous=size
+                                                > ASYNC_UPLOAD_THRESHOLD,
+                                                chunk_size=CHUNK_SIZE,
+                                                ignore_warnings=["was-deleted"],
+                                                # report_success=True,
+                                            )
+                                            assert r
+                                        except pywikibot.exceptions.UploadError as err:
+                                            e = err
+                                        # r = r or {}
+                                        if e:
+                                            if (
+                                                e.code == "was-deleted"
+                                            ):  # r.get("warnings", {}).get("exists"):
+                                                logger.warning(
+                                                    "Conflicts with existing page. Is there another worker running in parallel?"
+                                                )
+                                            elif (
+                                                e.code == "duplicate"
+                                            ):  # dup := r.get("warnings", {}).get("duplicate"):
+                                                # assert len(dup) == 1, f"{dup}"
+                                                # dup = dup[0]
+                                                return redirect_to_duplicate(e.msg)
+                                            else:
+                                                raise e
+                                        else:
+                                            # assert (
+                                            #     r.get("result")
+                                            #     or r.get("upload", {}).get("result")
+                                            # ) == "Success", f"Upload failed {r}"
+                                            assert r, "Upload failed"
+                                        return UPLOADED
+
+                                    ledger.mark(key, do1())
+                                    remove_page_spool(spool_path)
+                                except Exception as e:
+                                    on_failure(e)
+                                finally:
+                                    spool_path.unlink(missing_ok=True)
+
+                            job = (download, upload)
                         else:
                             if getopt("skip_on_existing", False):
                                 logger.debug(f"{pagename} exists, skipping")
+                                ledger.mark(
+                                    key,
+                                    UPLOADED,
+                                    pagename,
+                                    sha1=page_infos.get(pagename, PageInfo(True)).sha1,
+                                )
+                            elif (
+                                text := page_infos.get(pagename, PageInfo(True)).text
+                            ) is not None and normalize_wikitext(
+                                text
+                            ) == normalize_wikitext(
+                                volume_wikitext
+                            ):
+                                logger.debug(f"{pagename} is up to date, skipping")
+                                with counters_lock:
+                                    unchanged_cnt += 1
+                                ledger.mark(
+                                    key,
+                                    UPLOADED,
+                                    pagename,
+                                    sha1=page_infos[pagename].sha1,
+                                )
                             else:
                                 logger.info(f"{pagename} exists, updating wikitext")
 
@@ -665,12 +903,18 @@ def main():
                                     # r is None here
 
                                 do2()
+                                ledger.mark(
+                                    key,
+                                    UPLOADED,
+                                    pagename,
+                                    sha1=page_infos.get(pagename, PageInfo(True)).sha1,
+                                )
                     except Exception as e:
-                        failcnt += 1
-                        log_to_remote(f"[[:{pagename}]] upload failed")
-                        logger.warning("Upload failed", exc_info=e)
-                        if not getopt("skip_on_failures", False):
-                            raise e
+                        on_failure(e)
+                    if job:
+                        # kept out of the try above, as it may consume the upload of a
+                        # previously queued volume, which handles its own failures
+                        prefetcher.submit(*job)
 
                 nth = volume["index_in_book"] + 1
                 common_fields = f"""\
@@ -706,7 +950,16 @@ def main():
 [[{category_name}]]
 """
 
-                    do_upload(filename, pagename, primary_volume_wikitext, comment)
+                    submit_volume(
+                        do_upload,
+                        filename,
+                        pagename,
+                        primary_volume_wikitext,
+                        comment,
+                        category=category_name,
+                        prev=prev_filename,
+                        next=next_filename,
+                    )
                 else:
                     # TODO: source_url_fields
                     primary_volume_wikitext = f"""=={{{{int:filedesc}}}}==
@@ -735,19 +988,29 @@ def main():
 
 [[{category_name}]]
 """
-                    do_upload(
+                    submit_volume(
+                        do_upload,
                         filename,
                         pagename,
                         primary_volume_wikitext,
                         comment,
                         secondary=False,
+                        category=category_name,
+                        prev=prev_filename,
+                        next=next_filename,
+                        paired=secondary_filename,
                     )
-                    do_upload(
+                    submit_volume(
+                        do_upload,
                         secondary_filename,
                         secondary_pagename,
                         secondary_volume_wikitext,
                         secondary_comment,
                         secondary=True,
+                        category=category_name,
+                        prev=prev_secondary_filename,
+                        next=next_secondary_filename,
+                        paired=filename,
                     )
                 prev_secondary_filename = filename
                 prev_filename = filename
@@ -853,6 +1116,9 @@ def main():
                 }
 
             for ivol, volume in enumerate(volumes):
+                key = volume_key(dbid, book["id"], volume["id"])
+                if not should_process(key):
+                    continue
                 volume_identifier = f'nlc{dbid}-{book["id"]}-{volume["id"]}'
                 if f := (
                     existing_item and existing_item.filemap.get(volume_identifier)
@@ -860,6 +1126,7 @@ def main():
                     logger.debug(
                         f"{volume_identifier} exists in {identifier} as {f['title']}"
                     )
+                    ledger.mark(key, UPLOADED)
                     continue
                 volume_name = get_volume_name_for_filename(
                     volume, volumes[ivol - 1] if ivol >= 1 else None
@@ -870,6 +1137,7 @@ def main():
                 filename = f'NLC{dbid}-{book["id"]}-{volume["id"]} {fix_bookname_in_pagename(book["name"])}{book_name_suffix_wps}{volume_name_wps}.pdf'
                 if f := (existing_item and existing_item.filemap.get(filename)):
                     logger.debug(f"{f['title']} exists in {identifier}")
+                    ledger.mark(key, UPLOADED)
                     continue
                 iafilemetadata = {
                     "title": volume_name or None,
@@ -884,24 +1152,32 @@ def main():
                     logger.info(
                         f'Downloading {dbid},{book["id"]},{volume["id"]} ({ivol + 1}/{len(volumes)})'
                     )
-                    binary = getbook_unified(volume)
+                    downloaded = getbook_unified(
+                        volume,
+                        spool_path_for(dbid, book["id"], volume["id"]),
+                        cache=dlcache,
+                        strategy=download_strategy,
+                    )
+                    size = downloaded.size
+                    ledger.mark(key, DOWNLOADED, size=size)
                     # https://stackoverflow.com/a/17280876/5488616
-                    if len(binary) < MINIMUM_VALID_PDF_SIZE:
-                        log_to_remote(
-                            f"[[:{pagename}]] is too small ({len(binary)} < {MINIMUM_VALID_PDF_SIZE}) to be well-formed"
+                    if size < MINIMUM_VALID_PDF_SIZE:
+                        eventlog.log(
+                            f"[[:{pagename}]] is too small ({size} < {MINIMUM_VALID_PDF_SIZE}) to be well-formed"
                         )
                         raise Exception(
-                            f"PDF is too small ({len(binary)} < {MINIMUM_VALID_PDF_SIZE})"
+                            f"PDF is too small ({size} < {MINIMUM_VALID_PDF_SIZE})"
                         )
 
                     logger.info(
-                        f"Uploading {filename} as {volume_name or 'the only volume'} to {identifier} ({len(binary)} B)"
+                        f"Uploading {filename} as {volume_name or 'the only volume'} to {identifier} ({size} B)"
                     )
                     r = ia.upload(
                         identifier,
                         [
                             {
-                                "name": [filename, BytesIO(binary)],
+                                # read from the spool file rather than from memory
+                                "name": [filename, str(downloaded.path)],
                             }
                             | iafilemetadata
                         ],
@@ -914,16 +1190,41 @@ def main():
                         raise Exception(f"HTTP error {r.status_code} when uploading")
 
                 try:
+                    ledger.start(key, filename)
                     do_upload()
+                    ledger.mark(key, UPLOADED)
+                    remove_page_spool(spool_path_for(dbid, book["id"], volume["id"]))
                 except Exception as e:
                     failcnt += 1
-                    log_to_remote(f"[[:{pagename}]] upload failed")  # TODO: <-
+                    ledger.mark(key, FAILED, error=repr(e))
+                    eventlog.log(f"[[:{pagename}]] upload failed")  # TODO: <-
                     logger.warning("Upload failed", exc_info=e)
                     if not getopt("skip_on_failures", False):
                         raise e
-        store_position(batch_name, book["id"])
-    logger.info(f"Batch done with {failcnt} failures.")
-    log_to_remote(f"{batch_name} finished with {failcnt} failures.")
+                    remove_page_spool(spool_path_for(dbid, book["id"], volume["id"]))
+                finally:
+                    spool_path_for(dbid, book["id"], volume["id"]).unlink(
+                        missing_ok=True
+                    )
+    prefetcher.drain()
+    workers.join()
+    if manifest is not None:
+        manifest.close()
+        elapsed = time.monotonic() - start_time
+        logger.info(
+            f"Rendered {rendered_cnt} volumes into {render_only} in {elapsed:.1f}s ({rendered_cnt / max(elapsed, 1e-9):.0f} volumes/s)"
+        )
+        return
+    logger.info(
+        f"Batch done with {failcnt} failures, {unchanged_cnt} existing pages unchanged. Ledger: {ledger.summary()}"
+    )
+    if dlcache is not None:
+        logger.info(f"Download cache: {dlcache.stats()}")
+    if download_strategy == "direct":
+        logger.info(f"Doc servers: {doc_mirrors.metrics()}")
+    logger.info(f"NLC connections: {nlc_session.stats()}")
+    eventlog.log(f"{batch_name} finished with {failcnt} failures.")
+    eventlog.close()
 
 
 if __name__ == "__main__":
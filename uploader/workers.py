@@ -0,0 +1,61 @@
+"""Run volume jobs on a pool of worker threads"""
+
+import functools
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    """A fixed number of worker threads taking jobs from a shared bounded queue
+
+    The first exception escaping a job stops the pool from running further jobs. It is then
+    re-raised in the submitting thread on the next `submit` or `join`.
+
+    With `size` being 1 or less, jobs run inline in the submitting thread.
+    """
+
+    def __init__(self, size=1):
+        self.jobs = queue.Queue(maxsize=max(size, 1))
+        self.error = None
+        self.threads = []
+        if size > 1:
+            for i in range(size):
+                # daemonic so that a failing batch exits without waiting for running jobs
+                thread = threading.Thread(
+                    target=self._work, name=f"worker-{i + 1}", daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, fn, *args, **kwargs):
+        if not self.threads:
+            fn(*args, **kwargs)
+            return
+        self._raise_if_failed()
+        self.jobs.put(functools.partial(fn, *args, **kwargs))
+
+    def join(self):
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self._raise_if_failed()
+
+    def _raise_if_failed(self):
+        if self.error is not None:
+            raise self.error
+
+    def _work(self):
+        while (job := self.jobs.get()) is not None:
+            if self.error is not None:
+                continue  # drain the queue so that submitters won't block
+            try:
+                job()
+            except BaseException as e:
+                logger.debug(f"{threading.current_thread().name} stopped", exc_info=e)
+                if self.error is None:
+                    self.error = e